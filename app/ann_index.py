@@ -0,0 +1,144 @@
+# ann_index.py
+
+import os
+import numpy as np
+from symptom_index import normalize_rows, top_k, limit_blas_threads, DEFAULT_BLAS_THREADS
+
+# Categories with fewer rows are always searched exactly
+MIN_CATEGORY_ROWS = int(os.environ.get('Z_ANN_MIN_CATEGORY_ROWS', 20000))
+
+# Number of inverted lists probed per query
+DEFAULT_NPROBE = int(os.environ.get('Z_ANN_NPROBE', 8))
+
+# Training rows used per centroid and k-means iterations
+TRAINING_ROWS_PER_LIST = 64
+KMEANS_ITERATIONS = 10
+
+# Rows assigned to centroids per block, keeps the score matrix small
+ASSIGN_BLOCK_ROWS = 65536
+
+
+class CategoryLists:
+    """
+    Inverted lists of one category: the coarse centroids and the global rows of
+    every list, stored back to back.
+    """
+
+    def __init__(self, centroids, offsets, rows):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+
+    def candidates(self, query, nprobe, min_rows=0):
+        """
+        Returns the global rows of the nprobe lists closest to query, probing further
+        lists until at least min_rows rows are collected.
+        """
+        ranked = np.argsort(-(self.centroids @ query))
+        sizes = np.diff(self.offsets)[ranked]
+        probes = max(nprobe, int(np.searchsorted(np.cumsum(sizes), min_rows)) + 1)
+        return np.concatenate([self.rows[self.offsets[l]:self.offsets[l + 1]] for l in ranked[:probes]])
+
+
+class IVFIndex:
+    """
+    Approximate nearest-neighbour backend of a SymptomIndex using an inverted file
+    with coarse k-means centroids per category.
+
+    Only categories with at least min_category_rows rows get inverted lists; all
+    other categories, and searches over the whole index, stay on the exact path.
+    """
+
+    def __init__(self, index, nprobe=DEFAULT_NPROBE, min_category_rows=MIN_CATEGORY_ROWS, seed=0):
+        self.index = index
+        self.nprobe = nprobe
+        self.lists = {}
+        rng = np.random.default_rng(seed)
+        for category, (start, stop) in index.category_ranges.items():
+            if stop - start >= min_category_rows:
+                self.lists[category] = build_category_lists(index.matrix, start, stop, rng)
+
+    def covers(self, category):
+        """
+        Returns whether searches in category use the inverted lists.
+        """
+        return category in self.lists
+
+    def score_top_k(self, query_embeddings, category, top_n=10, nprobe=None, blas_threads=DEFAULT_BLAS_THREADS):
+        """
+        Returns the global row indices and scores of the approximate top_n rows per query,
+        probing the nprobe closest lists of the category.
+        """
+        if not self.covers(category):
+            return self.index.score_top_k(query_embeddings, category, top_n, blas_threads, exact=True)
+        lists = self.lists[category]
+        nprobe = nprobe or self.nprobe
+        queries = normalize_rows(np.array(query_embeddings, dtype=np.float32, ndmin=2))
+        top_n = min(top_n, len(lists.rows))
+        row_indices = np.empty((len(queries), top_n), dtype=np.int64)
+        scores = np.empty((len(queries), top_n), dtype=np.float32)
+        with limit_blas_threads(blas_threads):
+            # every query probes its own lists, so the candidates are scored per query
+            for i, query in enumerate(queries):
+                candidates = lists.candidates(query, nprobe, min_rows=top_n)
+                candidate_scores = self.index.matrix[candidates] @ query
+                best = top_k(candidate_scores, top_n)[0]
+                row_indices[i] = candidates[best]
+                scores[i] = candidate_scores[best]
+        return row_indices, scores
+
+    def recall(self, category, nprobe, top_n=10, sample=200, seed=0):
+        """
+        Estimates the recall@top_n of the category at nprobe, using sampled rows of
+        the category as queries and the exact search as ground truth.
+        """
+        start, stop = self.index.category_ranges[category]
+        rng = np.random.default_rng(seed)
+        queries = self.index.matrix[rng.choice(np.arange(start, stop), min(sample, stop - start), replace=False)]
+        exact, _ = self.index.score_top_k(queries, category, top_n, exact=True)
+        approximate, _ = self.score_top_k(queries, category, top_n, nprobe=nprobe)
+        found = sum(len(np.intersect1d(e, a)) for e, a in zip(exact, approximate))
+        return found / exact.size
+
+    def calibrate(self, target_recall=0.95, top_n=10, sample=200):
+        """
+        Sets nprobe to the smallest power of two reaching target_recall in every category.
+
+        Returns:
+        - The chosen nprobe.
+        """
+        nprobe = 1
+        for category, lists in self.lists.items():
+            while nprobe < len(lists.centroids) and self.recall(category, nprobe, top_n, sample) < target_recall:
+                nprobe *= 2
+        self.nprobe = min(nprobe, max((len(l.centroids) for l in self.lists.values()), default=1))
+        return self.nprobe
+
+
+def build_category_lists(matrix, start, stop, rng):
+    """
+    Trains spherical k-means centroids on a sample of the category rows and assigns
+    every row of the category to its closest centroid.
+    """
+    rows = stop - start
+    n_lists = max(1, int(np.sqrt(rows)))
+    sample = matrix[start + np.sort(rng.choice(rows, min(rows, n_lists * TRAINING_ROWS_PER_LIST), replace=False))]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        empty = np.bincount(assignment, minlength=n_lists) == 0
+        # Re-seed empty lists with random training rows
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+
+    assignment = np.empty(rows, dtype=np.int64)
+    for block in range(0, rows, ASSIGN_BLOCK_ROWS):
+        block_rows = matrix[start + block:start + min(block + ASSIGN_BLOCK_ROWS, rows)]
+        assignment[block:block + len(block_rows)] = np.argmax(block_rows @ centroids.T, axis=1)
+
+    order = np.argsort(assignment, kind='stable')
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=n_lists))))
+    return CategoryLists(centroids, offsets, start + order)
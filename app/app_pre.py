@@ -1,17 +1,30 @@
 # app.py
 
+import os
 import streamlit as st
-import awswrangler as wr
 import time
 from streamlit_tags import st_tags  # Added import for st_tags
 import boto3
 from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode
-from openai_utils import process_symptom_class, init_messages
+from openai_utils import process_symptom_class, stream_symptom_class, count_request_tokens
+from conversation import record_turn
 from ui import get_input_symptom_class, display_symptom_class_results, display_remedies, display_final_analysis, adjust_symptom_class
 import pandas as pd
+from embedding_store import sync_symptom_store
+from pipeline import start_speculative_search, take_speculative_search, prefetch_remedies
+from s3_sync import sync_s3_file, remote_etag
+from db_pool import validate_synthesis_db
+from ann_index import IVFIndex
+from text_index import BM25Index
+from repertorization import RemedyAccumulator
+from metrics import span, start_exporters
+from session_memory import enforce_session_budget
 from helpers import (
     initialize_openai,
     search_top_similar_symptoms,
+    search_symptoms_by_keywords,
+    search_case,
+    SEARCH_MODE,
     clear_session_state_vars,
     display_logo
 )
@@ -29,15 +42,63 @@ s3 = session.client('s3')
 # Initialize OpenAI client
 client = initialize_openai()
 
-# Load data
-def load_data():
-    symptom_data = wr.s3.read_parquet("s3://project-z-mambo/symptoms/relevant_symptoms.gz")[['id', 'category', 'path', 'path_embeddings']]
-    return symptom_data
+# Export the metrics of this process when configured
+start_exporters()
 
-@st.cache_data
-def download_s3_file(bucket_name, s3_key, local_filename):
-    s3 = boto3.client('s3')
-    s3.download_file(bucket_name, s3_key, local_filename)
+@st.cache_data(ttl=600, show_spinner=False)
+def symptom_data_version(bucket_name, s3_key):
+    """
+    Returns the ETag of the symptom parquet, checked at most every 10 minutes per
+    process, or None if S3 is not reachable.
+    """
+    try:
+        return remote_etag(s3, bucket_name, s3_key)
+    except Exception:
+        return None
+
+def load_symptom_index():
+    """
+    Returns the shared symptom index of the current version of the symptom parquet.
+    A new version is picked up within 10 minutes, synced and swapped in.
+    """
+    return open_symptom_index(symptom_data_version('project-z-mambo', 'symptoms/relevant_symptoms.gz'))
+
+@st.cache_resource(max_entries=1)
+def open_symptom_index(version):
+    """
+    Opens the shared symptom index of one version from the local memory-mapped store,
+    once per process and version. The store is only rebuilt from S3 when the ETag of
+    the parquet changed; with version None the last synced store is used.
+    """
+    with span('s3_symptom_load'):
+        index = sync_symptom_store(
+            s3,
+            'project-z-mambo',
+            'symptoms/relevant_symptoms.gz',
+            # Scan only a compact float16 or int8 copy when configured
+            storage=os.environ.get('Z_EMBEDDING_STORAGE', 'float32'),
+            etag=version
+        )
+    if SEARCH_MODE == 'hybrid':
+        index.lexical = BM25Index(index.paths)
+    # Attach the approximate backend for large categories when enabled
+    if os.environ.get('Z_ANN') == 'ivf':
+        index.ann = IVFIndex(index)
+        if os.environ.get('Z_ANN_TARGET_RECALL'):
+            index.ann.calibrate(target_recall=float(os.environ['Z_ANN_TARGET_RECALL']))
+    return index
+
+@st.cache_data(ttl=600)
+def sync_synthesis_db(bucket_name, s3_key, local_filename):
+    """
+    Syncs synthesis.db from S3, at most every 10 minutes per process.
+    Only changed versions are downloaded and they are swapped in atomically.
+
+    Returns:
+    - The ETag of the local synthesis.db.
+    """
+    with span('s3_synthesis_sync'):
+        return sync_s3_file(s3, bucket_name, s3_key, local_filename, validate=validate_synthesis_db)
 
 bucket_name = 'project-z-mambo'
 s3_key = 'symptoms/synthesis.db'
@@ -50,14 +111,14 @@ def proceed_to_mittelsuche():
     Cleans up 'top_results' and 'search_performed' from session state.
     """
     st.session_state.current_step = 'mittelsuche'
-    clear_session_state_vars(['top_results', 'search_performed', 'keywords', 'filtered_results_grid'])
+    clear_session_state_vars(['top_results', 'search_performed', 'keywords', 'filtered_results_grid', 'case_results'])
     st.rerun()
 
 
 # Initialize session state
 def initialize_session():
     if 'conversation' not in st.session_state:
-        st.session_state.conversation = init_messages()
+        st.session_state.conversation = []  # User and assistant turns, the static prompt is added per request
     if 'current_step' not in st.session_state:
         st.session_state.current_step = 'input_symptom_class'
     if 'user_input_symptom_class' not in st.session_state:
@@ -74,44 +135,128 @@ def initialize_session():
     if "top_results" not in st.session_state:
         st.session_state.top_results = pd.DataFrame()  # Empty DataFrame structure
     if 'final_results' not in st.session_state:
-        st.session_state.final_results = []  # Initialize as an empty list to store remedies
+        st.session_state.final_results = RemedyAccumulator()  # Running remedy totals of the included symptoms
     if 'keywords' not in st.session_state:
         st.session_state.keywords = []  # Initialize keywords list
 
 initialize_session()
+
+# Keep the state this session holds in server memory within its budget
+enforce_session_budget(st.session_state)
 # st.write("After click Current session state:", st.session_state)
 
-download_s3_file(bucket_name, s3_key, local_filename)
+sync_synthesis_db(bucket_name, s3_key, local_filename)
 
 # display logo
 display_logo("./app/images/logo_cat.webp", position_top=-30, position_right=10, width=80)
 
 
+# Stream the symptom classification and show each field as soon as it is complete
+STREAM_SYMPTOM_CLASS = os.environ.get('Z_STREAM_SYMPTOM_CLASS', '1') == '1'
+
+# Fields shown while the classification is streamed, in the order they arrive
+STREAMED_FIELDS = ('Oberkategorie', 'Unterkategorie', 'Suchpfad', 'Begründung')
+
+def stream_symptom_class_state(user_input, conversation):
+    """
+    Streams the symptom classification, rendering each field as soon as it arrives.
+
+    Returns:
+    - Tuple (oberkategorie, unterkategorie, suchpfad, begründung, raw response) like process_symptom_class.
+    """
+    placeholders = {field: st.empty() for field in STREAMED_FIELDS}
+    fields = {}
+    for field, value in stream_symptom_class(user_input, conversation):
+        fields[field] = value
+        if field in placeholders:
+            placeholders[field].markdown(f"**{field}**: {value}")
+    return fields.get('Oberkategorie'), fields.get('Unterkategorie'), fields.get('Suchpfad'), fields.get('Begründung'), fields['raw']
+
+
 # Define the new processing function within app.py
 def process_symptom_class_state():
     """
     Processes the symptom class input by calling the OpenAI function and stores the results.
     """
     user_input = st.session_state.get('user_input_symptom_class', '')
-    conversation = st.session_state.conversation  # Pass the full conversation
+    conversation = st.session_state.conversation  # Pass the session's turns
     try:
+        # Report the prompt size of this request
+        st.session_state.prompt_tokens = count_request_tokens(user_input, conversation)
         with st.spinner('Verarbeite Symptomklasse...'):
-            oberkategorie, unterkategorie, suchpfad, begründung, assisstant_response = process_symptom_class(user_input, conversation)
+            if STREAM_SYMPTOM_CLASS:
+                oberkategorie, unterkategorie, suchpfad, begründung, assisstant_response = stream_symptom_class_state(user_input, conversation)
+            else:
+                oberkategorie, unterkategorie, suchpfad, begründung, assisstant_response = process_symptom_class(user_input, conversation)
             # Store the outputs in session state
             st.session_state.oberkategorie = oberkategorie
             st.session_state.unterkategorie = unterkategorie
             st.session_state.suchpfad = suchpfad
             st.session_state.begründung = begründung
-            # Append the assistant response to the conversation
-            st.session_state.conversation = st.session_state.conversation +  [{ "role": "assistant", "content": [ { "text": assisstant_response, "type": "text" }] }]
+            # Append the user input and the assistant response to the conversation
+            st.session_state.conversation = record_turn(st.session_state.conversation, user_input, assisstant_response)
     except Exception as e:
         st.error(f"Fehler bei der Verarbeitung der Symptomklasse: {e}")
         st.stop()
 
+    # Start the search while the user reviews the classification, loading the index
+    # in the background on a cold process
+    start_speculative_search(
+        load_symptom_index,
+        st.session_state.suchpfad,
+        st.session_state.oberkategorie,
+        st.session_state.unterkategorie,
+        top_n=SEARCH_TOP_N
+    )
+
     # Transition to the new state
     st.session_state.current_step = 'display_symptom_class_results'
     st.rerun()
 
+# Number of similar symptoms returned by the search
+SEARCH_TOP_N = 100
+
+# Maximum number of keyword matches shown, ranked by similarity
+KEYWORD_TOP_N = 1000
+
+# Number of best visible results whose remedies are prefetched
+PREFETCH_TOP_N = 50
+
+# Columns of the result grids and of the selected rows
+RESULT_COLUMNS = ['id', 'category', 'path', 'similarity']
+
+def results_grid(results, key, height=400):
+    """
+    Shows search results in an AgGrid with multiple row selection.
+
+    Returns:
+    - DataFrame of the selected rows, empty if none are selected.
+    """
+    # Configure grid options
+    gb = GridOptionsBuilder.from_dataframe(results[RESULT_COLUMNS])
+    gb.configure_pagination(paginationAutoPageSize=True)  # Enable pagination
+    gb.configure_default_column(editable=False, groupable=True, filter=True)
+    gb.configure_selection(selection_mode="multiple", use_checkbox=True)  # Enable multiple row selection
+    grid_options = gb.build()
+
+    # Display the grid
+    grid_response = AgGrid(
+        results[RESULT_COLUMNS],
+        gridOptions=grid_options,
+        height=height,
+        fit_columns_on_grid_load=True,
+        update_mode=GridUpdateMode.SELECTION_CHANGED,  # Update on selection change
+        key=key
+    )
+
+    # Retrieve selected rows
+    selected = grid_response['selected_rows']
+
+    # Safely handle the selected rows without evaluating DataFrame in boolean context
+    if selected is not None and len(selected) > 0:
+        return pd.DataFrame(selected)
+    return pd.DataFrame(columns=RESULT_COLUMNS)
+
 # Step 4: Perform similarity search
 def perform_similarity_search():
     st.write("**Bestätigte Anfrage: Suche nach Treffer für Suchpfad**")
@@ -123,19 +268,25 @@ def perform_similarity_search():
 
     # Check if the similarity search has already been performed
     if not st.session_state.get('search_performed', False):
-        # Load data within the function to limit its scope and allow garbage collection
-        data = load_data()
-
         # Perform the similarity search
         try:
             with st.spinner('Ähnliche Symptome werden gesucht...'):
-                top_results = search_top_similar_symptoms(
+                # Use the search started in the background after the classification, if it matches
+                top_results = take_speculative_search(
                     st.session_state.suchpfad,
-                    data,
                     st.session_state.oberkategorie,
                     st.session_state.unterkategorie,
-                    top_n=100
+                    top_n=SEARCH_TOP_N
                 )
+                if top_results is None:
+                    top_results = search_top_similar_symptoms(
+                        st.session_state.suchpfad,
+                        # The process-wide symptom index, loaded only once per process
+                        load_symptom_index(),
+                        st.session_state.oberkategorie,
+                        st.session_state.unterkategorie,
+                        top_n=SEARCH_TOP_N
+                    )
             # Store top_results in session_state for filtering and selection
             st.session_state.top_results = top_results
             # Set the flag indicating the search has been performed
@@ -164,50 +315,27 @@ def perform_similarity_search():
         if not keywords:
             return top_results
         else:
-            # Apply AND logic: keep rows where 'path' contains all keywords
-            filtered = top_results.copy()
-            for kw in keywords:
-                filtered = filtered[filtered['path'].str.contains(kw, case=False, na=False)]
-            return filtered
+            # Apply AND logic over the whole category: keep rows where 'path' contains all keywords
+            return search_symptoms_by_keywords(
+                st.session_state.suchpfad,
+                load_symptom_index(),
+                st.session_state.oberkategorie,
+                st.session_state.unterkategorie,
+                keywords,
+                top_n=KEYWORD_TOP_N
+            )
 
     filtered_results = filter_top_results(top_results, st.session_state['keywords'])
 
     if filtered_results.empty:
         st.write("Keine Treffer gefunden. Bitte passen Sie Ihre Schlüsselwörter an.")
     else:
+        # Warm the remedy cache for the best visible results while the user selects
+        prefetch_remedies(filtered_results.nlargest(PREFETCH_TOP_N, 'similarity')['id'].tolist())
+
         # Display results using st_aggrid
         st.write("**Gefilterte Symptome:**")
-
-        # Configure grid options
-        gb = GridOptionsBuilder.from_dataframe(filtered_results[['id', 'category', 'path', 'similarity']])
-        gb.configure_pagination(paginationAutoPageSize=True)  # Enable pagination
-        gb.configure_default_column(editable=False, groupable=True, filter=True)
-        gb.configure_selection(selection_mode="multiple", use_checkbox=True)  # Enable multiple row selection
-        grid_options = gb.build()
-
-        # Display the grid
-        grid_response = AgGrid(
-            filtered_results[['id', 'category', 'path', 'similarity']],
-            gridOptions=grid_options,
-            height=400,
-            fit_columns_on_grid_load=True,
-            update_mode=GridUpdateMode.SELECTION_CHANGED,  # Update on selection change
-            key='filtered_results_grid'
-        )
-
-        # Initialize selected_rows in session state if it doesn't exist
-        if "selected_rows" not in st.session_state:
-            st.session_state.selected_rows = pd.DataFrame(
-                columns=['id', 'category', 'path', 'similarity'])  # Empty DataFrame
-
-        # Retrieve selected rows
-        selected = grid_response['selected_rows']
-
-        # Safely handle the selected rows without evaluating DataFrame in boolean context
-        if selected is not None and len(selected) > 0:
-            st.session_state.selected_rows = pd.DataFrame(selected)
-        else:
-            st.session_state.selected_rows = pd.DataFrame(columns=['id', 'category', 'path', 'similarity'])
+        st.session_state.selected_rows = results_grid(filtered_results, key='filtered_results_grid')
 
         # Check if selected_rows is not empty
         if not st.session_state.selected_rows.empty:
@@ -223,6 +351,80 @@ def perform_similarity_search():
 
 
 
+# Number of results shown per Suchpfad of a case
+CASE_TOP_N = 20
+
+# Number of best results per Suchpfad whose remedies are prefetched
+CASE_PREFETCH_TOP_N = 10
+
+# Case intake: search all Suchpfade of a case at once
+def perform_case_search():
+    """
+    Searches all Suchpfade of a case with one embeddings request and one scoring pass,
+    and shows the result sets together so the symptoms of all of them can be selected.
+    """
+    st.title("Fallaufnahme")
+    case_input = st.text_area(
+        "Suchpfade des Falls, ein Suchpfad pro Zeile:",
+        placeholder="Kopf - Schmerz - morgens\nGemüt - Angst - abends",
+        key='case_input'
+    )
+
+    col1, col2 = st.columns([1, 1])
+    with col1:
+        if st.button("Fall durchsuchen"):
+            suchpfade = [line.strip() for line in case_input.splitlines() if line.strip()]
+            if suchpfade:
+                try:
+                    with st.spinner('Ähnliche Symptome werden gesucht...'):
+                        results = search_case(suchpfade, load_symptom_index(), top_n=CASE_TOP_N)
+                    st.session_state.case_results = list(zip(suchpfade, results))
+                except Exception as e:
+                    st.error(f"Fehler bei der Suche nach ähnlichen Symptomen: {e}")
+                    st.stop()
+            else:
+                st.warning("Bitte geben Sie mindestens einen Suchpfad ein.")
+    with col2:
+        if st.button("Zurück zur Einzelsuche"):
+            clear_session_state_vars(['case_results'])
+            st.session_state.current_step = 'input_symptom_class'
+            st.rerun()
+
+    case_results = st.session_state.get('case_results')
+    if not case_results:
+        return
+
+    # Warm the remedy cache for the best results of every Suchpfad while the user selects
+    prefetch_remedies([
+        symptom_id
+        for _, results in case_results
+        for symptom_id in results['id'].head(CASE_PREFETCH_TOP_N).tolist()
+    ])
+
+    selected = []
+    for number, (suchpfad, results) in enumerate(case_results):
+        st.markdown(f"**Symptom {number + 1}:** {suchpfad}")
+        if results.empty:
+            st.write("Keine Treffer gefunden.")
+            continue
+        selected.append(results_grid(results, key=f'case_results_grid_{number}', height=250))
+
+    # The selections of all Suchpfade continue to the remedy search together
+    selected = [rows for rows in selected if not rows.empty]
+    if selected:
+        st.session_state.selected_rows = pd.concat(selected, ignore_index=True).drop_duplicates('id', ignore_index=True)
+    else:
+        st.session_state.selected_rows = pd.DataFrame(columns=RESULT_COLUMNS)
+
+    if not st.session_state.selected_rows.empty:
+        st.write("**Sie haben folgende Symptome ausgewählt:**")
+        for i, row in st.session_state.selected_rows.iterrows():
+            st.write(f"***Symptom_{i + 1}***: {row['category']} - {row['path']}")
+        st.button("Mittel finden", on_click=proceed_to_mittelsuche, key='case_mittel_finden')
+    else:
+        st.write("Keine Symptome ausgewählt.")
+
+
 # Main controller function
 def run_app():
     if st.session_state.current_step == 'input_symptom_class':
@@ -235,10 +437,13 @@ def run_app():
         adjust_symptom_class()
     elif st.session_state.current_step == 'search':
         perform_similarity_search()
+    elif st.session_state.current_step == 'case_intake':
+        perform_case_search()
     elif st.session_state.current_step == 'mittelsuche':
         display_remedies()
     elif st.session_state.current_step == 'final_analysis':
         display_final_analysis()
 
-# Run the app
-run_app()
+# Run the app, timing the whole rerun per step
+with span('rerun', step=st.session_state.current_step):
+    run_app()
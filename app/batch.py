@@ -0,0 +1,174 @@
+# batch.py
+#
+# Classifies and searches many symptom descriptions without the UI, e.g. to re-run
+# the archive of past cases after the corpus or the prompt changed:
+#
+#   python app/batch.py cases.jsonl results.jsonl --concurrency 4
+#
+# Records already in the output file without an error are skipped, so an interrupted
+# run resumes where it stopped and records that failed, e.g. on a rate limit, are retried.
+
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from openai_utils import process_symptom_class
+from helpers import get_embeddings
+from symptom_index import resolve_category
+from embedding_store import sync_symptom_store
+
+
+def read_records(input_path, text_field, id_field):
+    """
+    Reads the symptom descriptions of a JSONL or CSV file.
+
+    Returns:
+    - List of dicts with 'id' and 'text'; records without an id are numbered by line.
+    """
+    with open(input_path, encoding='utf-8', newline='') as f:
+        if input_path.endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    records = []
+    for number, row in enumerate(rows, start=1):
+        record_id = row.get(id_field)
+        # an id of 0 is an id, only a missing or empty one is replaced by the line number
+        if record_id is None or record_id == '':
+            record_id = number
+        records.append({'id': str(record_id), 'text': row[text_field]})
+    return records
+
+
+def read_checkpoint(output_path):
+    """
+    Returns the ids of the records already written to the output file.
+
+    Records written with an error, e.g. after a rate limit, do not count as done and are
+    processed again; their new line follows the error line in the output file.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    done = set()
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                record_id = result['id']
+            except (json.JSONDecodeError, KeyError, TypeError):
+                # a line cut off by an interrupted run is processed again
+                continue
+            if 'error' not in result:
+                done.add(record_id)
+    return done
+
+
+def ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def classify(record):
+    """
+    Classifies one symptom description with a fresh conversation.
+    """
+    try:
+        oberkategorie, unterkategorie, suchpfad, begründung, _ = process_symptom_class(record['text'], [])
+    except Exception as e:
+        return {**record, 'error': f'classification failed: {e}'}
+    return {
+        **record,
+        'oberkategorie': oberkategorie,
+        'unterkategorie': unterkategorie,
+        'suchpfad': suchpfad,
+        'begründung': begründung,
+    }
+
+
+def search_batch(index, results, top_n):
+    """
+    Embeds the Suchpfade of all classified results with one request and scores them
+    with one matrix product per category. The matches are added to the results.
+    """
+    classified = [result for result in results if 'error' not in result]
+    if not classified:
+        return
+    try:
+        embeddings = get_embeddings([result['suchpfad'] for result in classified])
+    except Exception as e:
+        for result in classified:
+            result['error'] = f'embedding failed: {e}'
+        return
+
+    by_category = {}
+    for result, embedding in zip(classified, embeddings):
+        category = resolve_category(result['oberkategorie'], result['unterkategorie'])
+        by_category.setdefault(category, []).append((result, embedding))
+
+    for category, group in by_category.items():
+        row_indices, scores = index.score_top_k([embedding for _, embedding in group], category, top_n)
+        for (result, _), rows, row_scores in zip(group, row_indices, scores):
+            # to_json converts the numpy values to plain JSON types
+            matches = index.to_frame(rows, row_scores).to_json(orient='records', force_ascii=False)
+            result['matches'] = json.loads(matches)
+
+
+def run_batch(input_path, output_path, text_field='text', id_field='id', concurrency=4, batch_size=32, top_n=20):
+    """
+    Classifies and searches all records of input_path and appends one JSON line per
+    record to output_path.
+
+    Parameters:
+    - input_path (str): JSONL or CSV file with the symptom descriptions.
+    - output_path (str): JSONL file the results are streamed to.
+    - text_field (str): Field holding the symptom description.
+    - id_field (str): Field holding the record id.
+    - concurrency (int): Number of classifications running at the same time.
+    - batch_size (int): Number of records embedded and searched together.
+    - top_n (int): Number of matches per record.
+    """
+    records = read_records(input_path, text_field, id_field)
+    done = read_checkpoint(output_path)
+    pending = [record for record in records if record['id'] not in done]
+    print(f"{len(records)} records, {len(done)} already done, {len(pending)} to process")
+
+    index = sync_symptom_store(
+        boto3.client('s3'),
+        'project-z-mambo',
+        'symptoms/relevant_symptoms.gz',
+        storage=os.environ.get('Z_EMBEDDING_STORAGE', 'float32')
+    )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, \
+            open(output_path, 'a', encoding='utf-8') as output:
+        # terminate a line cut off by an interrupted run
+        if output.tell() > 0 and not ends_with_newline(output_path):
+            output.write('\n')
+        for start in range(0, len(pending), batch_size):
+            results = list(executor.map(classify, pending[start:start + batch_size]))
+            search_batch(index, results, top_n)
+            for result in results:
+                output.write(json.dumps(result, ensure_ascii=False) + '\n')
+            # every written batch is a checkpoint
+            output.flush()
+            print(f"{min(start + batch_size, len(pending))}/{len(pending)} processed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify and search symptom descriptions in batch.")
+    parser.add_argument('input', help="JSONL or CSV file with the symptom descriptions")
+    parser.add_argument('output', help="JSONL file the results are appended to")
+    parser.add_argument('--text-field', default='text')
+    parser.add_argument('--id-field', default='id')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--top-n', type=int, default=20)
+    args = parser.parse_args()
+    run_batch(args.input, args.output, args.text_field, args.id_field, args.concurrency, args.batch_size, args.top_n)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# cache_store.py
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Directory holding the local cache databases
+CACHE_DIR = os.environ.get('Z_CACHE_DIR', '.cache')
+
+# Maximum number of bound parameters per SQLite statement
+SQLITE_MAX_PARAMETERS = 900
+
+
+class PersistentCache:
+    """
+    Size-bounded key/value cache backed by a local SQLite file with a process-wide
+    in-memory LRU tier in front of it.
+
+    Values are stored as bytes; encode and decode convert between the cached
+    objects and their stored form. Both tiers evict the least recently used entries,
+    and entries older than ttl seconds count as misses if a ttl is set.
+    """
+
+    def __init__(self, name, encode, decode, max_entries=100000, memory_entries=2048, path=None, ttl=None):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.path = path or os.path.join(CACHE_DIR, f'{name}.db')
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        # Open the SQLite file lazily, so importing the module never touches the disk
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, last_access REAL NOT NULL, created REAL NOT NULL DEFAULT 0)"
+            )
+            # Cache files created before the ttl support lack the created column
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(cache)")}
+            if 'created' not in columns:
+                conn.execute("ALTER TABLE cache ADD COLUMN created REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache(last_access)")
+            self._conn = conn
+        return self._conn
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Returns the cached value for key, or None on a miss.
+        """
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """
+        Returns a dict with the cached values of all keys that are in the cache.
+        """
+        found = {}
+        with self._lock:
+            oldest = time.time() - self.ttl if self.ttl else None
+            missing = []
+            for key in dict.fromkeys(keys):
+                if key in self._memory and (oldest is None or self._memory[key][1] >= oldest):
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key][0]
+                    self.memory_hits += 1
+                else:
+                    self._memory.pop(key, None)
+                    missing.append(key)
+            if missing:
+                conn = self._connect()
+                rows = []
+                # Stay below SQLite's limit of bound parameters per statement
+                for start in range(0, len(missing), SQLITE_MAX_PARAMETERS):
+                    chunk = missing[start:start + SQLITE_MAX_PARAMETERS]
+                    rows += conn.execute(
+                        f"SELECT key, value, created FROM cache WHERE key IN ({','.join('?' * len(chunk))})",
+                        chunk
+                    ).fetchall()
+                if oldest is not None:
+                    expired = [key for key, _, created in rows if created < oldest]
+                    if expired:
+                        conn.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key in expired])
+                        self.expired += len(expired)
+                    rows = [row for row in rows if row[2] >= oldest]
+                for key, value, created in rows:
+                    found[key] = self.decode(value)
+                    self._remember(key, found[key], created)
+                if rows:
+                    # Refresh the LRU position of the entries read from disk
+                    now = time.time()
+                    conn.executemany(
+                        "UPDATE cache SET last_access = ? WHERE key = ?",
+                        [(now, key) for key, _, _ in rows]
+                    )
+                conn.commit()
+                self.hits += len(rows)
+                self.misses += len(missing) - len(rows)
+        return found
+
+    def set(self, key, value):
+        """
+        Stores value under key.
+        """
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        """
+        Stores all key/value pairs of the dict items and evicts the least recently
+        used entries beyond max_entries.
+        """
+        if not items:
+            return
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, last_access, created) VALUES (?, ?, ?, ?)",
+                [(key, self.encode(value), now, now) for key, value in items.items()]
+            )
+            for key, value in items.items():
+                self._remember(key, value, now)
+            size = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            if size > self.max_entries:
+                conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_access LIMIT ?)",
+                    (size - self.max_entries,)
+                )
+            conn.commit()
+
+    def stats(self):
+        """
+        Returns the hit and miss counters of this process.
+        """
+        with self._lock:
+            lookups = self.hits + self.memory_hits + self.misses
+            return {
+                'name': self.name,
+                'hits': self.hits,
+                'memory_hits': self.memory_hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'hit_rate': (self.hits + self.memory_hits) / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+            }
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded in-memory LRU cache shared by all sessions of a process.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+            }
@@ -0,0 +1,122 @@
+# conversation.py
+
+import os
+import json
+import logging
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken is optional, without it tokens are estimated from the text length
+    tiktoken = None
+
+# Maximum number of tokens of the conversation history sent with each request,
+# the static system and few-shot prefix is not counted
+TOKEN_BUDGET = int(os.environ.get('Z_CONVERSATION_TOKEN_BUDGET', 2000))
+
+# Tokens added by the chat format per message
+TOKENS_PER_MESSAGE = 4
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding('o200k_base')
+    except Exception as e:
+        # tiktoken downloads the encoding on first use, without network tokens are estimated
+        logging.getLogger(__name__).warning("Token encoding not available, estimating tokens: %s", e)
+        return None
+
+
+def count_tokens(text):
+    """
+    Returns the number of tokens of text for gpt-4o, estimated without tiktoken.
+    """
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def message_tokens(message):
+    """
+    Returns the number of tokens of one chat message.
+    """
+    content = message['content']
+    if isinstance(content, list):
+        content = ''.join(part.get('text', '') for part in content)
+    return TOKENS_PER_MESSAGE + count_tokens(content)
+
+
+@lru_cache(maxsize=8)
+def _prefix_tokens(serialized_prefix):
+    return sum(message_tokens(message) for message in json.loads(serialized_prefix))
+
+
+def count_prompt_tokens(messages, prefix=()):
+    """
+    Returns the number of tokens of a request's messages. The tokens of a static
+    prefix are only counted once per process.
+    """
+    prefix = list(prefix)
+    if prefix and messages[:len(prefix)] == prefix:
+        return _prefix_tokens(json.dumps(prefix)) + sum(message_tokens(m) for m in messages[len(prefix):])
+    return sum(message_tokens(message) for message in messages)
+
+
+def user_turn(text):
+    return {"role": "user", "content": [{"text": text, "type": "text"}]}
+
+
+def assistant_turn(text):
+    return {"role": "assistant", "content": [{"text": text, "type": "text"}]}
+
+
+def trim_history(history, budget=TOKEN_BUDGET):
+    """
+    Drops the oldest turns of the history until it fits into budget tokens.
+
+    Turns are dropped in user/assistant pairs, so the trimmed history still starts
+    with a user turn.
+    """
+    tokens = [message_tokens(message) for message in history]
+    start = 0
+    total = sum(tokens)
+    while start < len(history) and total > budget:
+        total -= tokens[start]
+        start += 1
+        # never leave an assistant turn without the user turn it answers
+        while start < len(history) and history[start]['role'] != 'user':
+            total -= tokens[start]
+            start += 1
+    return history[start:]
+
+
+def build_messages(prefix, history, user_input, budget=TOKEN_BUDGET):
+    """
+    Builds the messages of a request.
+
+    The static prefix always comes first and unchanged, so provider-side prompt
+    caching applies; it is followed by the history trimmed to the token budget and
+    the new user turn.
+
+    Parameters:
+    - prefix (list of dict): The static system and few-shot messages.
+    - history (list of dict): User and assistant turns of the session.
+    - user_input (str): The new user input.
+    - budget (int): Token budget of the history and the new user turn.
+
+    Returns:
+    - List of messages.
+    """
+    turn = user_turn(user_input)
+    return list(prefix) + trim_history(history, budget - message_tokens(turn)) + [turn]
+
+
+def record_turn(history, user_input, assistant_response):
+    """
+    Returns the history extended by one user input and the assistant response to it.
+    """
+    return history + [user_turn(user_input), assistant_turn(assistant_response)]
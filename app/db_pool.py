@@ -0,0 +1,140 @@
+# db_pool.py
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+# Number of read-only connections per database file
+POOL_SIZE = int(os.environ.get('Z_SQLITE_POOL_SIZE', 8))
+
+# Bytes of the database file that SQLite may memory-map per connection
+MMAP_SIZE = 256 * 1024 * 1024
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of read-only SQLite connections to one database file.
+
+    Connections are opened in immutable URI mode with a shared page cache and
+    memory-mapped I/O, so they can be shared between Streamlit session threads.
+    """
+
+    def __init__(self, db_path, size=POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self.uri = Path(os.path.abspath(db_path)).as_uri() + '?mode=ro&immutable=1&cache=shared'
+        self.file_version = file_version(db_path)
+        self.closed = False
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._tables = None
+
+    def _open(self):
+        conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Yields a pooled connection and returns it to the pool afterwards.
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                return self._open()
+        # All connections are in use, wait for one to be returned
+        while True:
+            try:
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                if self.closed:
+                    # A closed pool gets no connections back, open a one-off connection
+                    return self._open()
+
+    def _release(self, conn):
+        if self.closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    def has_table(self, name):
+        """
+        Returns whether the database has the table name, read once per pool.
+        """
+        if self._tables is None:
+            with self.connection() as conn:
+                self._tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        return name in self._tables
+
+    def close(self):
+        """
+        Closes all idle connections; connections in use are closed when they are returned.
+        """
+        self.closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def file_version(db_path):
+    """
+    Returns a tuple identifying the current file behind db_path.
+    """
+    stat = os.stat(db_path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def get_pool(db_path):
+    """
+    Returns the process-wide connection pool of db_path.
+
+    A new pool is created when the file was replaced, because immutable connections
+    would keep reading the old file.
+    """
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None or pool.file_version != file_version(db_path):
+            if pool is not None:
+                pool.close()
+            pool = ConnectionPool(db_path)
+            _pools[db_path] = pool
+        return pool
+
+
+def validate_synthesis_db(db_path):
+    """
+    Raises a ValueError if db_path is not an intact synthesis database.
+    """
+    conn = sqlite3.connect(Path(os.path.abspath(db_path)).as_uri() + '?mode=ro', uri=True)
+    try:
+        result = conn.execute("PRAGMA quick_check").fetchone()[0]
+        if result != 'ok':
+            raise ValueError(f"synthesis.db failed the integrity check: {result}")
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        missing = {'symptom_remedies', 'remedies'} - tables
+        if missing:
+            raise ValueError(f"synthesis.db is missing the tables: {', '.join(sorted(missing))}")
+    finally:
+        conn.close()
@@ -0,0 +1,220 @@
+# embedding_store.py
+
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cache_store import CACHE_DIR
+from s3_sync import remote_etag, version_name
+from symptom_index import SymptomIndex, CompactMatrix, build_symptom_index, quantize_matrix
+from text_index import NgramIndex, build_postings, fold
+
+# Directory holding one sub directory per synced version of the symptom data
+STORE_DIR = os.environ.get('Z_EMBEDDING_STORE_DIR', os.path.join(CACHE_DIR, 'symptom_store'))
+
+# File naming the version currently in use
+CURRENT_FILE = 'CURRENT'
+
+
+def write_store(index, directory, etag):
+    """
+    Writes a SymptomIndex as a local binary store: the float32 matrix, the ids and the
+    n-gram posting lists of the paths as .npy files plus JSON sidecars with the paths
+    and the category ranges.
+    """
+    np.save(os.path.join(directory, 'matrix.npy'), index.matrix)
+    # object ids can not be memory-mapped, store them as fixed width strings
+    ids = index.ids.astype(str) if index.ids.dtype == object else index.ids
+    np.save(os.path.join(directory, 'ids.npy'), ids)
+    with open(os.path.join(directory, 'paths.json'), 'w', encoding='utf-8') as f:
+        json.dump(index.paths.tolist(), f, ensure_ascii=False)
+    write_postings(directory, build_postings([fold(path) for path in index.paths]))
+    # metadata.json is written last and marks the store as complete
+    with open(os.path.join(directory, 'metadata.json'), 'w', encoding='utf-8') as f:
+        json.dump({'etag': etag, 'category_ranges': index.category_ranges}, f, ensure_ascii=False)
+
+
+def open_store(directory, storage='float32'):
+    """
+    Opens a local store as a SymptomIndex with memory-mapped matrices, so all worker
+    processes of a node share one page cache copy.
+
+    Parameters:
+    - directory (str): Directory of the store version.
+    - storage (str): 'float32', or 'float16'/'int8' to scan a compact copy of the matrix.
+
+    Returns:
+    - SymptomIndex backed by the store.
+    """
+    with open(os.path.join(directory, 'metadata.json'), encoding='utf-8') as f:
+        metadata = json.load(f)
+    with open(os.path.join(directory, 'paths.json'), encoding='utf-8') as f:
+        paths = np.asarray(json.load(f), dtype=object)
+    category_ranges = {category: tuple(rows) for category, rows in metadata['category_ranges'].items()}
+
+    # categories are not stored, rows are sorted by category
+    categories = np.empty(len(paths), dtype=object)
+    for category, (start, stop) in category_ranges.items():
+        categories[start:stop] = category
+
+    index = SymptomIndex(
+        np.load(os.path.join(directory, 'ids.npy'), mmap_mode='r'),
+        categories,
+        paths,
+        np.load(os.path.join(directory, 'matrix.npy'), mmap_mode='r'),
+        category_ranges
+    )
+    index.text_index = open_text_index(directory, paths)
+    if storage != 'float32':
+        index.compact = open_compact(directory, storage, index.matrix)
+    return index
+
+
+def write_postings(directory, postings):
+    grams, offsets, rows = postings
+    save_atomic(os.path.join(directory, 'ngram_grams.npy'), grams)
+    save_atomic(os.path.join(directory, 'ngram_offsets.npy'), offsets)
+    # the rows are written last and mark the posting lists as complete
+    save_atomic(os.path.join(directory, 'ngram_rows.npy'), rows)
+
+
+def open_text_index(directory, paths):
+    """
+    Returns the NgramIndex of a store with memory-mapped posting lists, building them
+    on first use for stores written without them.
+    """
+    if not os.path.exists(os.path.join(directory, 'ngram_rows.npy')):
+        index = NgramIndex(paths)
+        try:
+            write_postings(directory, (index.grams, index.offsets, index.rows))
+        except OSError:
+            # e.g. the version was pruned by a process that synced a newer one
+            pass
+        return index
+    postings = tuple(
+        np.load(os.path.join(directory, f'ngram_{name}.npy'), mmap_mode='r')
+        for name in ('grams', 'offsets', 'rows')
+    )
+    return NgramIndex(paths, postings)
+
+
+def open_compact(directory, mode, matrix):
+    """
+    Returns the memory-mapped compact matrix of a store, building it on first use.
+    """
+    codes_path = os.path.join(directory, f'codes_{mode}.npy')
+    scales_path = os.path.join(directory, f'scales_{mode}.npy')
+    if not os.path.exists(codes_path):
+        compact = quantize_matrix(matrix, mode)
+        if compact.scales is not None:
+            save_atomic(scales_path, compact.scales)
+        # the codes are written last and mark the compact matrix as complete
+        save_atomic(codes_path, compact.codes)
+    scales = np.load(scales_path, mmap_mode='r') if os.path.exists(scales_path) else None
+    return CompactMatrix(np.load(codes_path, mmap_mode='r'), scales)
+
+
+def save_atomic(path, array):
+    """
+    Saves array as .npy and renames it into place, so readers never see a partial file.
+    """
+    temporary_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(temporary_path, array)
+    os.replace(temporary_path, path)
+
+
+def current_version(store_dir=STORE_DIR):
+    """
+    Returns the name of the store version currently in use, or None.
+    """
+    try:
+        with open(os.path.join(store_dir, CURRENT_FILE), encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def set_current_version(store_dir, version):
+    """
+    Atomically points the CURRENT file at version.
+    """
+    temporary_path = os.path.join(store_dir, f'{CURRENT_FILE}.{os.getpid()}.tmp')
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        f.write(version)
+    os.replace(temporary_path, os.path.join(store_dir, CURRENT_FILE))
+
+
+def sync_symptom_store(s3_client, bucket_name, s3_key, store_dir=STORE_DIR, storage='float32', etag=None):
+    """
+    Opens the local store of the symptom parquet, building it only when the ETag of
+    the S3 object changed.
+
+    Parameters:
+    - s3_client: boto3 S3 client.
+    - bucket_name (str): Bucket of the symptom parquet.
+    - s3_key (str): Key of the symptom parquet.
+    - store_dir (str): Directory holding the store versions.
+    - storage (str): Storage mode passed to open_store.
+    - etag (str): ETag of the S3 object if the caller already checked it, otherwise
+      it is read with a HEAD request.
+
+    Returns:
+    - SymptomIndex backed by the memory-mapped store.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    if etag is None:
+        try:
+            etag = remote_etag(s3_client, bucket_name, s3_key)
+        except Exception:
+            # Keep serving the last synced version when S3 is not reachable
+            version = current_version(store_dir)
+            if version is None:
+                raise
+            return open_store(os.path.join(store_dir, version), storage)
+
+    version = version_name(etag)
+    directory = os.path.join(store_dir, version)
+    if not os.path.exists(os.path.join(directory, 'metadata.json')):
+        build_store(s3_client, bucket_name, s3_key, etag, directory)
+    if current_version(store_dir) != version:
+        set_current_version(store_dir, version)
+        prune_versions(store_dir, keep=version)
+    return open_store(directory, storage)
+
+
+def build_store(s3_client, bucket_name, s3_key, etag, directory):
+    """
+    Downloads the symptom parquet of the given ETag and writes its store to directory.
+    """
+    response = s3_client.get_object(Bucket=bucket_name, Key=s3_key, IfMatch=f'"{etag}"')
+    table = pq.read_table(
+        pa.BufferReader(response['Body'].read()),
+        columns=['id', 'category', 'path', 'path_embeddings']
+    )
+    index = build_symptom_index(table)
+    del table, response
+
+    # Build in a temporary directory and rename it into place
+    temporary_directory = tempfile.mkdtemp(prefix=f'.{os.path.basename(directory)}.', dir=os.path.dirname(directory))
+    try:
+        write_store(index, temporary_directory, etag)
+        os.rename(temporary_directory, directory)
+    except OSError:
+        # Another process finished the same version first
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        if not os.path.exists(os.path.join(directory, 'metadata.json')):
+            raise
+
+
+def prune_versions(store_dir, keep):
+    """
+    Removes all store versions except keep. Processes that still map an old version
+    keep reading it until they exit.
+    """
+    for name in os.listdir(store_dir):
+        path = os.path.join(store_dir, name)
+        if name != keep and not name.startswith('.') and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
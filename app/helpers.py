@@ -1,51 +1,218 @@
 # helpers.py
 
-import openai
 from openai import OpenAI
 import boto3
-import sqlite3
 import json
 import os
+import hashlib
+import threading
+from contextlib import contextmanager
+import httpx
+import unicodedata
 import pandas as pd
 import numpy as np
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 import streamlit as st
 import toml
+from symptom_index import resolve_category, path_category
+from text_index import hybrid_score_top_k
+from cache_store import PersistentCache, SQLITE_MAX_PARAMETERS
+from db_pool import get_pool, file_version
+from repertorization import load_remedy_matrix, remedies_query, REMEDY_DETAILS_TABLE
+from s3_sync import local_version
+from metrics import span, increment, record_usage
+
+# Timeouts in seconds and connection limits of the shared OpenAI client
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get('Z_OPENAI_CONNECT_TIMEOUT', 5))
+OPENAI_READ_TIMEOUT = float(os.environ.get('Z_OPENAI_READ_TIMEOUT', 60))
+OPENAI_MAX_CONNECTIONS = int(os.environ.get('Z_OPENAI_MAX_CONNECTIONS', 20))
+
+# Maximum number of OpenAI requests in flight per process
+OPENAI_MAX_CONCURRENCY = int(os.environ.get('Z_OPENAI_MAX_CONCURRENCY', 8))
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+_openai_slots = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+
+def get_openai_api_key():
+    """
+    Returns the OpenAI key from the Streamlit secrets, or from OPENAI_API_KEY outside Streamlit.
+    """
+    try:
+        return st.secrets["OPENAI_KEY"]
+    except Exception:
+        return os.environ["OPENAI_API_KEY"]
 
 # Initialize OpenAI client
 def initialize_openai():
-    # secrets = toml.load("secrets.toml")
-    # os.environ["OPENAI_API_KEY"] = secrets.get("OPENAI_KEY")
-    os.environ["OPENAI_API_KEY"] = st.secrets["OPENAI_KEY"]
-    # Return the OpenAI client instance if necessary
-    client = OpenAI()
-    return client
+    """
+    Returns the process-wide OpenAI client, creating it on first use.
+    All sessions share its pool of keep-alive HTTP connections.
+    """
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                    keepalive_expiry=120
+                ),
+                timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+            )
+            _openai_client = OpenAI(
+                api_key=get_openai_api_key(),
+                http_client=http_client,
+                timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+            )
+        return _openai_client
+
+@contextmanager
+def openai_slot():
+    """
+    Limits the number of OpenAI requests in flight per process, waiting for a free slot.
+    """
+    with _openai_slots:
+        yield
+
+# Process-wide cache of query embeddings, persisted in a local SQLite file
+embedding_cache = PersistentCache(
+    'embeddings',
+    encode=lambda embedding: np.asarray(embedding, dtype=np.float32).tobytes(),
+    decode=lambda value: np.frombuffer(value, dtype=np.float32),
+    max_entries=int(os.environ.get('Z_EMBEDDING_CACHE_ENTRIES', 200000))
+)
+
+def embedding_cache_key(text, model, dimensions):
+    """
+    Returns the cache key of a text: the hash of model, dimensions and the normalized text.
+    """
+    normalized = ' '.join(unicodedata.normalize('NFC', text).split())
+    return hashlib.sha256(json.dumps([model, dimensions, normalized]).encode('utf-8')).hexdigest()
 
 # Retry logic for getting embeddings
-@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
-def get_embeddings(texts, model="text-embedding-3-large"):
-    response = openai.embeddings.create(input=texts, model=model,dimensions=256)
+@retry(
+    wait=wait_random_exponential(min=1, max=20),
+    stop=stop_after_attempt(6),
+    before_sleep=lambda retry_state: increment('openai_retries', operation='embeddings')
+)
+def create_embeddings(texts, model="text-embedding-3-large", dimensions=256):
+    with openai_slot(), span('openai_embeddings'):
+        response = initialize_openai().embeddings.create(input=texts, model=model, dimensions=dimensions)
+    record_usage(model, response.usage)
     return [item.embedding for item in response.data]
 
+def get_embeddings(texts, model="text-embedding-3-large", dimensions=256):
+    """
+    Returns the embeddings of texts, only texts missing in the embedding cache are sent to the API.
+
+    Parameters:
+    - texts (list of str): Texts to embed.
+    - model (str): Embedding model.
+    - dimensions (int): Number of embedding dimensions.
+
+    Returns:
+    - List of float32 embeddings in the order of texts.
+    """
+    keys = [embedding_cache_key(text, model, dimensions) for text in texts]
+    embeddings = embedding_cache.get_many(keys)
+    increment('embedding_cache', len(embeddings), result='hit')
+    increment('embedding_cache', len(keys) - len(embeddings), result='miss')
+    # embed every missing text only once, in a single request
+    missing = {key: text for key, text in zip(keys, texts) if key not in embeddings}
+    if missing:
+        created = create_embeddings(list(missing.values()), model=model, dimensions=dimensions)
+        created = {key: np.asarray(embedding, dtype=np.float32) for key, embedding in zip(missing, created)}
+        embedding_cache.set_many(created)
+        embeddings.update(created)
+    return [embeddings[key] for key in keys]
+
+# Ranking of the symptom search: 'vector' (cosine similarity) or 'hybrid' (cosine fused with BM25)
+SEARCH_MODE = os.environ.get('Z_SEARCH_MODE', 'vector')
+
 # Function to search for top similar symptoms
-def search_top_similar_symptoms(user_query, data, llm_oberkategorie, llm_unterkategorie, top_n=10):
-    # first filter database on llm_oberkategorie or llm_unterkategorie
-    if llm_oberkategorie == 'Körper':
-        data = data[data['category'] == llm_unterkategorie]
-    else:
-        data = data[data['category'] == llm_oberkategorie]
-    # after filtering get embeddings of user query
+def search_top_similar_symptoms(user_query, index, llm_oberkategorie, llm_unterkategorie, top_n=10, mode=SEARCH_MODE):
+    """
+    Searches the symptom index for the symptoms most similar to the user query.
+
+    Parameters:
+    - user_query (str): The search path to embed and search for.
+    - index (SymptomIndex): The process-wide symptom index.
+    - llm_oberkategorie (str): Oberkategorie returned by the LLM.
+    - llm_unterkategorie (str): Unterkategorie returned by the LLM.
+    - top_n (int): Number of results to return.
+    - mode (str): 'vector' ranks by cosine similarity, 'hybrid' fuses it with the
+      BM25 ranking of the paths (requires index.lexical).
+
+    Returns:
+    - DataFrame with 'id', 'category', 'path' and 'similarity' columns.
+    """
+    # search only the slice of the llm_oberkategorie or llm_unterkategorie
+    category = resolve_category(llm_oberkategorie, llm_unterkategorie)
+    # get embeddings of user query
     user_embedding = get_embeddings([user_query])[0]
-    # stack all embeddings of symptoms
-    embeddings_matrix = np.vstack(data['path_embeddings'].values)
-    # calculate cosine similarities
-    cosine_similarities = np.dot(embeddings_matrix, user_embedding)
-    # get top n similar symptoms
-    top_indices = cosine_similarities.argsort()[::-1][:top_n]
-    top_scores = cosine_similarities[top_indices]
-    top_symptoms = data.iloc[top_indices].copy()
-    top_symptoms['similarity'] = top_scores
-    return top_symptoms
+    with span('vector_search', mode=mode):
+        if mode == 'hybrid':
+            [(row_indices, similarities)] = hybrid_score_top_k(index, [user_query], [user_embedding], category, top_n)
+            return index.to_frame(row_indices, similarities)
+        return index.search(user_embedding, category=category, top_n=top_n)
+
+
+def search_case(suchpfade, index, top_n=10, mode=SEARCH_MODE):
+    """
+    Searches the symptom index for all Suchpfade of a case at once: one embeddings
+    request for all of them and one matrix product per category they fall into.
+
+    Parameters:
+    - suchpfade (list of str): The Suchpfade of the case. The first segment of each
+      path names its category; paths of unknown categories search the whole index.
+    - index (SymptomIndex): The process-wide symptom index.
+    - top_n (int): Number of results per Suchpfad.
+    - mode (str): 'vector' or 'hybrid', see search_top_similar_symptoms.
+
+    Returns:
+    - List with one DataFrame with 'id', 'category', 'path' and 'similarity' columns per Suchpfad.
+    """
+    embeddings = get_embeddings(list(suchpfade))
+    groups = {}
+    for position, suchpfad in enumerate(suchpfade):
+        groups.setdefault(path_category(suchpfad, index.category_ranges), []).append(position)
+
+    results = [None] * len(suchpfade)
+    with span('vector_search', mode=mode):
+        for category, positions in groups.items():
+            texts = [suchpfade[position] for position in positions]
+            queries = [embeddings[position] for position in positions]
+            if mode == 'hybrid':
+                ranked = hybrid_score_top_k(index, texts, queries, category, top_n)
+            else:
+                ranked = zip(*index.score_top_k(queries, category, top_n))
+            for position, (row_indices, scores) in zip(positions, ranked):
+                results[position] = index.to_frame(row_indices, scores)
+    return results
+
+
+def search_symptoms_by_keywords(user_query, index, llm_oberkategorie, llm_unterkategorie, keywords, top_n=None):
+    """
+    Finds all symptoms of the category whose path contains every keyword and ranks
+    them by their similarity to the user query.
+
+    Parameters:
+    - user_query (str): The search path the results are ranked by.
+    - index (SymptomIndex): The process-wide symptom index with its text_index.
+    - llm_oberkategorie (str): Oberkategorie returned by the LLM.
+    - llm_unterkategorie (str): Unterkategorie returned by the LLM.
+    - keywords (list of str): Keywords matched case-insensitively as substrings of the path.
+    - top_n (int): Maximum number of results, None returns all matches.
+
+    Returns:
+    - DataFrame with 'id', 'category', 'path' and 'similarity' columns.
+    """
+    rows = index.category_slice(resolve_category(llm_oberkategorie, llm_unterkategorie))
+    matches = index.text_index.rows_containing_all(keywords, rows)
+    # the query embedding comes from the embedding cache
+    user_embedding = get_embeddings([user_query])[0]
+    return index.rank_rows(user_embedding, matches, top_n=top_n)
 
 
 def get_remedies(symptom_id, db_path='synthesis.db'):
@@ -59,26 +226,61 @@ def get_remedies(symptom_id, db_path='synthesis.db'):
     Returns:
     - List of dictionaries containing remedy information and the associated symptom_id.
     """
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    return get_remedies_bulk([symptom_id], db_path=db_path)[symptom_id]
 
-    # Query to get remedies associated with the symptom_id
-    query = """
-    SELECT remedies.remedy_abbreviation, remedies.description, symptom_remedies.degree
-    FROM symptom_remedies
-    JOIN remedies ON symptom_remedies.remedy_abbreviation = remedies.remedy_abbreviation
-    WHERE symptom_remedies.symptom_id = ?;
+
+def get_remedies_bulk(symptom_ids, db_path='synthesis.db'):
+    """
+    Retrieves the remedies of many symptoms with one query per chunk of ids,
+    using a pooled read-only connection.
+
+    Parameters:
+    - symptom_ids (list of int): The IDs of the symptoms.
+    - db_path (str): Path to the SQLite database file.
+
+    Returns:
+    - Dict mapping each symptom_id to its list of remedy dictionaries.
+    """
+    # numpy integers can not be bound as SQLite parameters
+    symptom_ids = list(dict.fromkeys(
+        symptom_id.item() if isinstance(symptom_id, np.generic) else symptom_id
+        for symptom_id in symptom_ids
+    ))
+    remedies = {symptom_id: [] for symptom_id in symptom_ids}
+
+    pool = get_pool(db_path)
+    # A prepared database has the remedies of every symptom in one table, see prepare_synthesis_db.py
+    details = pool.has_table(REMEDY_DETAILS_TABLE)
+    with span('sqlite_remedies'), pool.connection() as conn:
+        # Stay below SQLite's limit of bound parameters per statement
+        for start in range(0, len(symptom_ids), SQLITE_MAX_PARAMETERS):
+            chunk = symptom_ids[start:start + SQLITE_MAX_PARAMETERS]
+            # Query to get remedies associated with the symptom_ids
+            for r in conn.execute(remedies_query(len(chunk), details), chunk):
+                remedies[r[0]].append({'abbreviation': r[1], 'description': r[2], 'degree': r[3], 'symptom_id': r[0]})
+
+    return remedies
+
+def get_db_version(db_path='synthesis.db'):
+    """
+    Returns the version of the local database: the ETag it was synced from, or its
+    file identity if it was not synced from S3.
     """
+    return local_version(db_path) or '-'.join(str(part) for part in file_version(db_path))
 
-    cursor.execute(query, (symptom_id,))
-    remedies = cursor.fetchall()
 
-    # Close the connection
-    conn.close()
+@st.cache_resource(max_entries=1)
+def _load_remedy_matrix(db_path, db_file_version):
+    # db_file_version is part of the cache key, so a replaced database is reloaded
+    with span('load_remedy_matrix'):
+        return load_remedy_matrix(db_path, version=db_file_version)
 
-    # Format the results
-    return [{'abbreviation': r[0], 'description': r[1], 'degree': r[2], 'symptom_id': symptom_id} for r in remedies]
+
+def get_remedy_matrix(db_path='synthesis.db'):
+    """
+    Returns the process-wide sparse symptom x remedy matrix of the database.
+    """
+    return _load_remedy_matrix(db_path, file_version(db_path))
 
 # helpers.py
 
@@ -106,29 +308,21 @@ def partial_reset_session_state():
 
 
 
-def add_to_final_results(remedies, symptom_id):
+def add_to_final_results(symptom_id):
     """
-    Adds remedies to the final_results session state, tagging them with symptom_id.
+    Adds the remedies of a symptom to the running totals of the final_results session state.
     Parameters:
-    - remedies (list of dict): List of remedies to add.
-    - symptom_id (int): The ID of the symptom the remedies are associated with.
+    - symptom_id (int): The ID of the symptom whose remedies should be added.
     """
-    # Tag each remedy with the symptom_id
-    for remedy in remedies:
-        remedy_copy = remedy.copy()
-        remedy_copy['symptom_id'] = symptom_id
-        st.session_state.final_results.append(remedy_copy)
+    st.session_state.final_results.include(symptom_id, get_remedy_matrix())
 
 def remove_from_final_results(symptom_id):
     """
-    Removes remedies associated with a specific symptom_id from the final_results session state.
+    Removes the remedies of a symptom from the running totals of the final_results session state.
     Parameters:
     - symptom_id (int): The ID of the symptom whose remedies should be removed.
     """
-    st.session_state.final_results = [
-        remedy for remedy in st.session_state.final_results
-        if remedy.get('symptom_id') != symptom_id
-    ]
+    st.session_state.final_results.exclude(symptom_id, get_remedy_matrix())
 
 
 
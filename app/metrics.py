@@ -0,0 +1,320 @@
+# metrics.py
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+from cache_store import CACHE_DIR
+
+try:
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+except ImportError:  # outside Streamlit there are no sessions, usage is only counted per process
+    get_script_run_ctx = None
+
+# Comma separated exporters: 'prometheus' serves /metrics, 'jsonl' appends every event to a rotating file
+EXPORT = {name.strip() for name in os.environ.get('Z_METRICS_EXPORT', '').split(',') if name.strip()}
+
+# Port of the Prometheus endpoint, every worker process needs its own
+PROMETHEUS_PORT = int(os.environ.get('Z_METRICS_PORT', 9464))
+
+# Event file and its rotation
+JSONL_PATH = os.environ.get('Z_METRICS_JSONL', os.path.join(CACHE_DIR, 'metrics.jsonl'))
+JSONL_MAX_BYTES = int(os.environ.get('Z_METRICS_JSONL_BYTES', 50 * 1024 * 1024))
+JSONL_BACKUPS = int(os.environ.get('Z_METRICS_JSONL_BACKUPS', 5))
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# USD per million tokens
+MODEL_PRICES = {
+    'gpt-4o': {'prompt': 2.50, 'cached_prompt': 1.25, 'completion': 10.00},
+    'text-embedding-3-large': {'prompt': 0.13, 'cached_prompt': 0.13, 'completion': 0.0},
+}
+
+# Number of sessions whose usage is kept, the oldest are dropped first
+MAX_SESSIONS = 10000
+
+
+class Registry:
+    """
+    Thread-safe process-wide counters, latency histograms and per-session usage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.sessions = OrderedDict()
+
+    def increment(self, name, amount=1, labels=()):
+        with self._lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + amount
+
+    def set_gauge(self, name, value, labels=()):
+        with self._lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, seconds, labels=()):
+        with self._lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                # bucket counts, then sum and count
+                histogram = self.histograms[(name, labels)] = [0] * len(BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def add_session_usage(self, session_id, usage):
+        with self._lock:
+            totals = self.sessions.pop(session_id, None) or {}
+            for key, value in usage.items():
+                totals[key] = totals.get(key, 0) + value
+            self.sessions[session_id] = totals
+            while len(self.sessions) > MAX_SESSIONS:
+                self.sessions.popitem(last=False)
+            return dict(totals)
+
+    def session_totals(self, session_id):
+        with self._lock:
+            return dict(self.sessions.get(session_id, {}))
+
+    def render_prometheus(self):
+        """
+        Returns all counters and histograms in the Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, list(values)) for key, values in self.histograms.items())
+        lines = []
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f'# TYPE z_{name}_total counter')
+                declared.add(name)
+            lines.append(f'z_{name}_total{format_labels(labels)} {value}')
+        for (name, labels), value in gauges:
+            if name not in declared:
+                lines.append(f'# TYPE z_{name} gauge')
+                declared.add(name)
+            lines.append(f'z_{name}{format_labels(labels)} {value}')
+        for (name, labels), values in histograms:
+            if name not in declared:
+                lines.append(f'# TYPE z_{name}_seconds histogram')
+                declared.add(name)
+            # the bucket counts are already cumulative
+            for bound, count in zip(BUCKETS, values):
+                lines.append(f'z_{name}_seconds_bucket{format_labels(labels + (("le", str(bound)),))} {count}')
+            lines.append(f'z_{name}_seconds_bucket{format_labels(labels + (("le", "+Inf"),))} {values[-1]}')
+            lines.append(f'z_{name}_seconds_sum{format_labels(labels)} {values[-2]}')
+            lines.append(f'z_{name}_seconds_count{format_labels(labels)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels) + '}'
+
+
+registry = Registry()
+
+_events = None
+_exporters_lock = threading.Lock()
+_exporters_started = False
+
+# Session the work of a background thread is attributed to, see attributed_to
+_attribution = threading.local()
+
+
+def current_session_id():
+    """
+    Returns the id of the Streamlit session running the current thread, or the session
+    the current background job is attributed to, or None.
+    """
+    session_id = getattr(_attribution, 'session_id', None)
+    if session_id is not None:
+        return session_id
+    if get_script_run_ctx is None:
+        return None
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx is not None else None
+
+
+@contextmanager
+def attributed_to(session_id):
+    """
+    Attributes the spans and usage recorded in the enclosed block to session_id.
+
+    Threads of the background pool have no script run context, so jobs capture the
+    session id when they are submitted and run inside this context.
+    """
+    previous = getattr(_attribution, 'session_id', None)
+    _attribution.session_id = session_id
+    try:
+        yield
+    finally:
+        _attribution.session_id = previous
+
+
+def emit(event):
+    """
+    Appends an event to the JSONL file when that exporter is enabled.
+    """
+    if _events is not None:
+        _events.info(json.dumps({'time': time.time(), **event}, ensure_ascii=False, default=str))
+
+
+@contextmanager
+def span(name, **labels):
+    """
+    Times the enclosed block into the latency histogram name, also when it raises.
+
+    Parameters:
+    - name (str): Name of the operation, e.g. 'openai_chat'.
+    - labels: Low-cardinality labels, e.g. step='search'.
+    """
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except BaseException as e:
+        # Streamlit ends a rerun with control flow exceptions, they are no errors
+        outcome = 'error' if isinstance(e, Exception) and type(e).__module__.split('.')[0] != 'streamlit' else 'ok'
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        labels = tuple(sorted(labels.items()))
+        registry.observe(name, seconds, labels)
+        if outcome == 'error':
+            registry.increment(f'{name}_errors', labels=labels)
+        emit({'type': 'span', 'name': name, 'seconds': seconds, 'outcome': outcome,
+              'labels': dict(labels), 'session': current_session_id()})
+
+
+def observe(name, seconds, **labels):
+    """
+    Adds one duration in seconds to the latency histogram name.
+    """
+    labels = tuple(sorted(labels.items()))
+    registry.observe(name, seconds, labels)
+    emit({'type': 'span', 'name': name, 'seconds': seconds, 'outcome': 'ok',
+          'labels': dict(labels), 'session': current_session_id()})
+
+
+def increment(name, amount=1, **labels):
+    """
+    Adds amount to the counter name, e.g. increment('embedding_cache', 3, result='hit').
+    """
+    registry.increment(name, amount, tuple(sorted(labels.items())))
+
+
+def set_gauge(name, value, **labels):
+    """
+    Sets the current value of the gauge name, e.g. set_gauge('session_memory_bytes', 2**20).
+    """
+    registry.set_gauge(name, value, tuple(sorted(labels.items())))
+
+
+def record_usage(model, usage):
+    """
+    Counts the tokens and the cost of one OpenAI response, per process and per session.
+
+    Parameters:
+    - model (str): The requested model, used to look up its price.
+    - usage: The usage object of the response, may be None.
+
+    Returns:
+    - The cost of the response in USD.
+    """
+    if usage is None:
+        return 0.0
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = (getattr(details, 'cached_tokens', 0) or 0) if details is not None else 0
+
+    prices = MODEL_PRICES.get(model, {})
+    cost = (
+        (prompt_tokens - cached_tokens) * prices.get('prompt', 0.0)
+        + cached_tokens * prices.get('cached_prompt', 0.0)
+        + completion_tokens * prices.get('completion', 0.0)
+    ) / 1e6
+
+    increment('openai_tokens', prompt_tokens - cached_tokens, model=model, kind='prompt')
+    increment('openai_tokens', cached_tokens, model=model, kind='cached_prompt')
+    increment('openai_tokens', completion_tokens, model=model, kind='completion')
+    increment('openai_cost_usd', cost, model=model)
+
+    session_id = current_session_id()
+    usage = {'prompt_tokens': prompt_tokens, 'cached_tokens': cached_tokens,
+             'completion_tokens': completion_tokens, 'cost_usd': cost, 'requests': 1}
+    totals = registry.add_session_usage(session_id, usage) if session_id is not None else None
+    emit({'type': 'usage', 'model': model, **usage, 'session': session_id, 'session_totals': totals})
+    return cost
+
+
+def session_usage(session_id=None):
+    """
+    Returns the token and cost totals of a session, the current one by default.
+    """
+    return registry.session_totals(session_id or current_session_id())
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = registry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_exporters():
+    """
+    Starts the configured exporters once per process.
+    """
+    global _events, _exporters_started
+    with _exporters_lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+
+        if 'jsonl' in EXPORT:
+            os.makedirs(os.path.dirname(os.path.abspath(JSONL_PATH)), exist_ok=True)
+            handler = RotatingFileHandler(JSONL_PATH, maxBytes=JSONL_MAX_BYTES, backupCount=JSONL_BACKUPS, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger = logging.getLogger('z.metrics')
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            _events = logger
+
+        if 'prometheus' in EXPORT:
+            try:
+                server = ThreadingHTTPServer(('0.0.0.0', PROMETHEUS_PORT), _MetricsHandler)
+            except OSError as e:
+                # e.g. another worker process of the node already serves the port
+                logging.getLogger(__name__).warning("Metrics endpoint not started on port %s: %s", PROMETHEUS_PORT, e)
+                return
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
@@ -1,10 +1,15 @@
 # openai_utils.py
 
 import openai
-from helpers import initialize_openai  # Assuming get_secret is in helpers.py
+from helpers import initialize_openai, openai_slot
 import json
-# Initialize OpenAI client
-client = initialize_openai()
+import re
+import os
+import hashlib
+import time
+from cache_store import PersistentCache
+from conversation import build_messages, count_prompt_tokens
+from metrics import span, observe, increment, record_usage
 
 # fucntion to init messages
 def init_messages():
@@ -129,26 +134,20 @@ def init_messages():
   ]
 
 
-# Placeholder for the new function
-def process_symptom_class(user_input, conversation):
+def build_symptom_class_request(user_input, conversation):
     """
-    Processes the symptom class by making a call to OpenAI's model.
+    Builds the keyword arguments of the chat completion classifying a symptom.
 
     Parameters:
     - user_input (str): The input provided by the user.
+    - conversation (list of dict): The user and assistant turns so far, without the static prompt.
 
     Returns:
-    - response (str): The response from OpenAI's model.
+    - Dict of keyword arguments for client.chat.completions.create.
     """
-
-    # init messages
-    messages = conversation
-    # init client
-    client = initialize_openai()
-
-    response_content = client.chat.completions.create(
+    return dict(
         model="gpt-4o",
-        messages= messages + [{ "role": "user", "content": [ { "text": user_input, "type": "text" }] }],
+        messages=build_messages(init_messages(), conversation, user_input),
         temperature=0.1,
         max_tokens=200,
         frequency_penalty=0,
@@ -242,9 +241,137 @@ def process_symptom_class(user_input, conversation):
 
         }
     )
-    # Return the response
-    response_dict_raw = response_content.choices[0].message.content
+
+
+# Persistent cache of symptom classifications, keyed on the complete request
+classification_cache = PersistentCache(
+    'classifications',
+    encode=lambda result: json.dumps(result, ensure_ascii=False).encode('utf-8'),
+    decode=lambda value: tuple(json.loads(value)),
+    max_entries=int(os.environ.get('Z_CLASSIFICATION_CACHE_ENTRIES', 50000)),
+    ttl=float(os.environ.get('Z_CLASSIFICATION_CACHE_TTL', 30 * 24 * 3600))
+)
+
+
+def classification_cache_key(request):
+    """
+    Returns the canonical hash of a request: model, parameters, JSON schema and messages.
+    """
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def count_request_tokens(user_input, conversation):
+    """
+    Returns the number of prompt tokens of the request classifying user_input.
+    """
+    return count_prompt_tokens(build_symptom_class_request(user_input, conversation)['messages'], init_messages())
+
+
+def parse_symptom_class(response_dict_raw):
+    """
+    Returns the (Oberkategorie, Unterkategorie, Suchpfad, Begründung, raw) tuple of a response.
+    """
     # load json
     response_dict = json.loads(response_dict_raw)
     return  response_dict.get("Oberkategorie"), response_dict.get("Unterkategorie"), response_dict.get("Suchpfad"), response_dict.get("Begründung"), response_dict_raw
 
+
+# Placeholder for the new function
+def process_symptom_class(user_input, conversation):
+    """
+    Processes the symptom class by making a call to OpenAI's model.
+    Identical requests are answered from the classification cache.
+
+    Parameters:
+    - user_input (str): The input provided by the user.
+
+    Returns:
+    - response (str): The response from OpenAI's model.
+    """
+    request = build_symptom_class_request(user_input, conversation)
+    cache_key = classification_cache_key(request)
+    cached = classification_cache.get(cache_key)
+    increment('classification_cache', result='hit' if cached is not None else 'miss')
+    if cached is not None:
+        return cached
+
+    # get the shared client
+    client = initialize_openai()
+
+    with openai_slot(), span('openai_chat', stream='0'):
+        response_content = client.chat.completions.create(**request)
+    record_usage(request['model'], response_content.usage)
+    # Return the response
+    result = parse_symptom_class(response_content.choices[0].message.content)
+    classification_cache.set(cache_key, result)
+    return result
+
+
+class StreamedFields:
+    """
+    Incremental parser for the streamed JSON object of the symptom classification.
+    Returns every string field as soon as its closing quote has arrived.
+    """
+
+    FIELD = re.compile(r'"((?:[^"\\]|\\.)*)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+    def __init__(self):
+        self.buffer = ''
+        self.position = 0
+
+    def feed(self, chunk):
+        """
+        Adds a chunk of the response and returns the list of newly completed (field, value) pairs.
+        """
+        self.buffer += chunk
+        completed = []
+        for match in self.FIELD.finditer(self.buffer, self.position):
+            completed.append((json.loads(f'"{match.group(1)}"'), json.loads(f'"{match.group(2)}"')))
+            self.position = match.end()
+        return completed
+
+
+def stream_symptom_class(user_input, conversation):
+    """
+    Streams the symptom classification and yields each field as soon as it is complete.
+
+    Parameters:
+    - user_input (str): The input provided by the user.
+    - conversation (list of dict): The conversation so far.
+
+    Yields:
+    - (field, value) tuples in the order of the response ('Symptom', 'Oberkategorie',
+      'Unterkategorie', 'Suchpfad', 'Begründung'), then ('raw', complete response).
+    """
+    request = build_symptom_class_request(user_input, conversation)
+    cache_key = classification_cache_key(request)
+    cached = classification_cache.get(cache_key)
+    increment('classification_cache', result='hit' if cached is not None else 'miss')
+    if cached is not None:
+        # A cached response is replayed at once
+        yield from StreamedFields().feed(cached[-1])
+        yield 'raw', cached[-1]
+        return
+
+    # get the shared client
+    client = initialize_openai()
+
+    parser = StreamedFields()
+    # the slot is held until the stream is consumed
+    with openai_slot(), span('openai_chat', stream='1'):
+        start = time.perf_counter()
+        first_token = None
+        # the last chunk carries the token usage of the request
+        stream = client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                    observe('openai_chat_first_token', first_token)
+                yield from parser.feed(chunk.choices[0].delta.content)
+            if chunk.usage is not None:
+                record_usage(request['model'], chunk.usage)
+    # validate the complete response like the non-streaming call does
+    classification_cache.set(cache_key, parse_symptom_class(parser.buffer))
+    yield 'raw', parser.buffer
@@ -0,0 +1,120 @@
+# pipeline.py
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+from cache_store import LRUCache
+from metrics import increment, current_session_id, attributed_to
+from helpers import search_top_similar_symptoms, get_remedies_bulk, get_db_version
+
+# Process-wide pool running background work of all sessions
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('Z_BACKGROUND_WORKERS', 4)),
+    thread_name_prefix='background'
+)
+
+def submit(function, *args):
+    """
+    Submits a background job attributed to the session submitting it, so its spans
+    and token usage are recorded for that session.
+    """
+    return executor.submit(_run_attributed, current_session_id(), function, *args)
+
+
+def _run_attributed(session_id, function, *args):
+    with attributed_to(session_id):
+        return function(*args)
+
+
+# Remedies of recently shown symptoms, keyed by (synthesis.db version, symptom id)
+remedy_cache = LRUCache(max_entries=int(os.environ.get('Z_REMEDY_CACHE_ENTRIES', 20000)))
+
+
+def start_speculative_search(load_index, suchpfad, oberkategorie, unterkategorie, top_n=100):
+    """
+    Starts loading the symptom index, embedding the Suchpfad and searching the index
+    in the background, while the user still reviews the classification.
+
+    The speculation is best-effort: if loading the index or searching fails, the
+    search step searches again in the foreground and reports the error there.
+    The future is parked in the session and consumed by take_speculative_search.
+
+    Parameters:
+    - load_index (callable): Returns the process-wide SymptomIndex, e.g. load_symptom_index.
+    """
+    discard_speculative_search()
+    key = (suchpfad, oberkategorie, unterkategorie, top_n)
+    future = submit(_speculative_search, load_index, suchpfad, oberkategorie, unterkategorie, top_n)
+    st.session_state.speculative_search = (key, future)
+
+
+def _speculative_search(load_index, suchpfad, oberkategorie, unterkategorie, top_n):
+    # on a cold process the index is loaded here instead of on the script thread
+    return search_top_similar_symptoms(suchpfad, load_index(), oberkategorie, unterkategorie, top_n)
+
+
+def take_speculative_search(suchpfad, oberkategorie, unterkategorie, top_n=100):
+    """
+    Returns the result of the speculative search if it was started for the same
+    Suchpfad and categories, otherwise None. Failed searches also return None, so
+    the caller searches again in the foreground.
+    """
+    speculative = st.session_state.pop('speculative_search', None)
+    if speculative is None:
+        return None
+    key, future = speculative
+    if key != (suchpfad, oberkategorie, unterkategorie, top_n):
+        future.cancel()
+        return None
+    try:
+        return future.result()
+    except Exception:
+        return None
+
+
+def discard_speculative_search():
+    """
+    Discards the speculative search of the session, e.g. when the user submits feedback.
+    """
+    speculative = st.session_state.pop('speculative_search', None)
+    if speculative is not None:
+        speculative[1].cancel()
+
+
+def prefetch_remedies(symptom_ids, db_path='synthesis.db'):
+    """
+    Warms the remedy cache for the given symptoms in the background.
+    """
+    version = get_db_version(db_path)
+    missing = [symptom_id for symptom_id in symptom_ids if (version, symptom_id) not in remedy_cache]
+    if missing:
+        submit(_fetch_remedies, missing, version, db_path)
+
+
+def _fetch_remedies(symptom_ids, version, db_path):
+    fetched = get_remedies_bulk(symptom_ids, db_path=db_path)
+    for symptom_id, remedies in fetched.items():
+        remedy_cache.set((version, symptom_id), remedies)
+    return fetched
+
+
+def get_remedies_cached(symptom_ids, db_path='synthesis.db'):
+    """
+    Returns the remedies of the given symptoms from the remedy cache, fetching only
+    the symptoms that were not prefetched.
+
+    Returns:
+    - Dict mapping each symptom_id to its list of remedy dictionaries.
+    """
+    version = get_db_version(db_path)
+    remedies = {}
+    for symptom_id in symptom_ids:
+        cached = remedy_cache.get((version, symptom_id))
+        if cached is not None:
+            remedies[symptom_id] = cached
+    missing = [symptom_id for symptom_id in symptom_ids if symptom_id not in remedies]
+    increment('remedy_cache', len(remedies), result='hit')
+    increment('remedy_cache', len(missing), result='miss')
+    if missing:
+        remedies.update(_fetch_remedies(missing, version, db_path))
+    return remedies
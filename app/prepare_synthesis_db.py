@@ -0,0 +1,187 @@
+# prepare_synthesis_db.py
+#
+# Turns a synthesis.db as exported upstream into a read-optimized snapshot for the
+# app, whatever indexes the export came with:
+#
+#   python app/prepare_synthesis_db.py synthesis.db prepared.db --denormalize
+#   python app/prepare_synthesis_db.py synthesis.db prepared.db --publish s3://project-z-mambo/symptoms/synthesis.db
+#
+# The snapshot gets covering indexes for the remedy lookups, ANALYZE statistics,
+# the chosen page size and a VACUUM. Optionally it also gets a WITHOUT ROWID table
+# holding the remedies of every symptom in degree order, which the app then reads
+# instead of the join. The query plans of the app's queries are verified before
+# the snapshot is written and published.
+
+import argparse
+import os
+import sqlite3
+import tempfile
+from pathlib import Path
+import boto3
+from db_pool import validate_synthesis_db
+from repertorization import remedies_query, REMEDY_DETAILS_TABLE
+
+# Page size of the snapshot in bytes, a power of two between 512 and 65536
+DEFAULT_PAGE_SIZE = 8192
+
+INDEXES = [
+    # symptom_id first for the IN lookup, the other columns make the index covering
+    "CREATE INDEX IF NOT EXISTS idx_symptom_remedies_covering "
+    "ON symptom_remedies (symptom_id, remedy_abbreviation, degree)",
+    # the join looks remedies up by abbreviation and reads only the description
+    "CREATE INDEX IF NOT EXISTS idx_remedies_covering "
+    "ON remedies (remedy_abbreviation, description)",
+]
+
+
+def create_remedy_details(conn):
+    """
+    Creates the denormalized REMEDY_DETAILS_TABLE, clustered by symptom and degree.
+
+    Returns:
+    - False, after dropping the table again, if symptom_remedies has duplicate links
+      the table could not hold, otherwise True.
+    """
+    conn.execute(f"DROP TABLE IF EXISTS {REMEDY_DETAILS_TABLE}")
+    conn.execute(f"""
+        CREATE TABLE {REMEDY_DETAILS_TABLE} (
+            symptom_id INTEGER NOT NULL,
+            degree INTEGER,
+            remedy_abbreviation TEXT NOT NULL,
+            description TEXT,
+            PRIMARY KEY (symptom_id, degree DESC, remedy_abbreviation)
+        ) WITHOUT ROWID
+    """)
+    inserted = conn.execute(f"""
+        INSERT OR IGNORE INTO {REMEDY_DETAILS_TABLE} (symptom_id, degree, remedy_abbreviation, description)
+        SELECT symptom_remedies.symptom_id, symptom_remedies.degree, remedies.remedy_abbreviation, remedies.description
+        FROM symptom_remedies
+        JOIN remedies ON symptom_remedies.remedy_abbreviation = remedies.remedy_abbreviation
+        ORDER BY symptom_remedies.symptom_id, symptom_remedies.degree DESC, remedies.remedy_abbreviation
+    """).rowcount
+    joined = conn.execute("""
+        SELECT COUNT(*)
+        FROM symptom_remedies
+        JOIN remedies ON symptom_remedies.remedy_abbreviation = remedies.remedy_abbreviation
+    """).fetchone()[0]
+    if inserted != joined:
+        # the join would return rows the table dropped, keep reading the join
+        conn.execute(f"DROP TABLE {REMEDY_DETAILS_TABLE}")
+        return False
+    return True
+
+
+def query_plan(conn, query, parameters):
+    """
+    Returns the details of the EXPLAIN QUERY PLAN rows of a query.
+    """
+    return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", parameters)]
+
+
+def verify_query_plans(conn, details):
+    """
+    Raises a RuntimeError unless the remedy lookups of the app read only indexes.
+
+    Returns:
+    - The verified query plans, one list of plan details per query.
+    """
+    parameters = [1, 2, 3]
+    plans = [query_plan(conn, remedies_query(len(parameters)), parameters)]
+    if details:
+        plans.append(query_plan(conn, remedies_query(len(parameters), details=True), parameters))
+
+    for plan in plans:
+        for detail in plan:
+            if not detail.startswith(('SEARCH', 'SCAN')):
+                continue
+            # a SCAN of a table or a SEARCH that still reads table rows
+            index_only = 'COVERING INDEX' in detail or (
+                REMEDY_DETAILS_TABLE in detail and 'PRIMARY KEY' in detail
+            )
+            if detail.startswith('SCAN') or not index_only:
+                raise RuntimeError(f"Remedy lookup is not an index-only read: {detail}")
+    return plans
+
+
+def prepare_synthesis_db(source_path, output_path, page_size=DEFAULT_PAGE_SIZE, denormalize=False):
+    """
+    Writes the read-optimized snapshot of source_path to output_path.
+
+    Parameters:
+    - source_path (str): The synthesis.db as exported upstream, it is not modified.
+    - output_path (str): Path of the snapshot, replaced atomically.
+    - page_size (int): Page size of the snapshot in bytes.
+    - denormalize (bool): Also create the per-symptom REMEDY_DETAILS_TABLE.
+
+    Returns:
+    - The verified query plans.
+    """
+    validate_synthesis_db(source_path)
+    directory = os.path.dirname(os.path.abspath(output_path))
+    fd, temporary_path = tempfile.mkstemp(prefix=f'.{os.path.basename(output_path)}.', dir=directory)
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(temporary_path, isolation_level=None)
+        try:
+            # the backup API also copies changes still in the WAL file of the source
+            source = sqlite3.connect(Path(os.path.abspath(source_path)).as_uri() + '?mode=ro', uri=True)
+            try:
+                source.backup(conn)
+            finally:
+                source.close()
+            # readers open the snapshot immutable, it must not depend on a WAL file
+            conn.execute("PRAGMA journal_mode=DELETE")
+            conn.execute("BEGIN")
+            for statement in INDEXES:
+                conn.execute(statement)
+            details = denormalize and create_remedy_details(conn)
+            if denormalize and not details:
+                print(f"symptom_remedies has duplicate links, {REMEDY_DETAILS_TABLE} was not created")
+            conn.execute("COMMIT")
+            conn.execute("ANALYZE")
+            # the page size takes effect with the VACUUM that rebuilds the file
+            conn.execute(f"PRAGMA page_size={int(page_size)}")
+            conn.execute("VACUUM")
+            plans = verify_query_plans(conn, details)
+        finally:
+            conn.close()
+        validate_synthesis_db(temporary_path)
+        os.replace(temporary_path, output_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return plans
+
+
+def publish(output_path, s3_url):
+    """
+    Uploads the snapshot to an s3://bucket/key URL, where the app syncs it from.
+    """
+    bucket_name, _, s3_key = s3_url[len('s3://'):].partition('/')
+    boto3.client('s3').upload_file(output_path, bucket_name, s3_key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare a read-optimized synthesis.db snapshot.")
+    parser.add_argument('source', help="synthesis.db as exported upstream")
+    parser.add_argument('output', help="path of the prepared snapshot")
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument('--denormalize', action='store_true',
+                        help=f"also create the per-symptom table {REMEDY_DETAILS_TABLE}")
+    parser.add_argument('--publish', metavar='S3_URL', help="upload the snapshot, e.g. s3://bucket/symptoms/synthesis.db")
+    args = parser.parse_args()
+    if args.publish and not args.publish.startswith('s3://'):
+        parser.error("--publish needs an s3://bucket/key URL")
+
+    plans = prepare_synthesis_db(args.source, args.output, args.page_size, args.denormalize)
+    for plan in plans:
+        print("query plan:", '; '.join(plan))
+    print(f"wrote {args.output} ({os.path.getsize(args.output) / 2**20:.1f} MiB)")
+    if args.publish:
+        publish(args.output, args.publish)
+        print(f"published to {args.publish}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ import pandas as pd
 import numpy as np
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 from tqdm import tqdm
+from symptom_index import top_k
 
 
 def get_secret():
@@ -61,7 +62,7 @@ def search_top_similar_symptoms(user_query, data, top_n=10):
     cosine_similarities = np.dot(embeddings_matrix, user_embedding)
 
     # Schritt 5: Sortierung und Auswahl der Top-N ähnlichen Einträge
-    top_indices = cosine_similarities.argsort()[::-1][:top_n]
+    top_indices = top_k(cosine_similarities, top_n)[0]
     top_scores = cosine_similarities[top_indices]
     top_symptoms = data.iloc[top_indices].copy()
     top_symptoms['similarity'] = top_scores
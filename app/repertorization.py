@@ -0,0 +1,200 @@
+# repertorization.py
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from db_pool import get_pool
+
+# Denormalized per-symptom remedy table written by prepare_synthesis_db.py
+REMEDY_DETAILS_TABLE = 'symptom_remedy_details'
+
+
+def remedies_query(parameters=None, details=False):
+    """
+    Returns the query of the symptom remedies with their descriptions as columns
+    symptom_id, remedy_abbreviation, description and degree.
+
+    Parameters:
+    - parameters (int): Number of symptom ids bound to an IN list, None selects all symptoms.
+    - details (bool): Read the denormalized REMEDY_DETAILS_TABLE instead of joining
+      symptom_remedies and remedies.
+    """
+    if details:
+        query = f"""
+        SELECT symptom_id, remedy_abbreviation, description, degree
+        FROM {REMEDY_DETAILS_TABLE}
+        """
+        column = 'symptom_id'
+    else:
+        query = """
+        SELECT symptom_remedies.symptom_id, remedies.remedy_abbreviation, remedies.description, symptom_remedies.degree
+        FROM symptom_remedies
+        JOIN remedies ON symptom_remedies.remedy_abbreviation = remedies.remedy_abbreviation
+        """
+        column = 'symptom_remedies.symptom_id'
+    if parameters is not None:
+        query += f"WHERE {column} IN ({','.join('?' * parameters)})"
+    return query + ';'
+
+
+class RemedyMatrix:
+    """
+    Sparse symptom x remedy matrix of the whole repertory with degrees as values.
+
+    Scoring a set of symptoms sums their rows, so the final analysis costs a few
+    vectorized sparse operations regardless of how many rubrics are selected.
+    """
+
+    def __init__(self, symptom_ids, abbreviations, descriptions, matrix, version=None):
+        self.symptom_ids = symptom_ids
+        self.abbreviations = abbreviations
+        self.descriptions = descriptions
+        self.matrix = matrix
+        self.version = version
+        self.symptom_rows = pd.Series(np.arange(len(symptom_ids)), index=symptom_ids)
+
+    def rows_of(self, symptom_ids):
+        """
+        Returns the matrix rows of the given symptom ids, unknown ids are skipped.
+        """
+        rows = self.symptom_rows.reindex(pd.unique(np.asarray(list(symptom_ids))))
+        return rows.dropna().to_numpy(dtype=np.int64)
+
+    def row_entries(self, symptom_id):
+        """
+        Returns the remedy columns and degrees of one symptom, empty for unknown ids.
+        """
+        row = self.symptom_rows.get(symptom_id)
+        if row is None:
+            return np.empty(0, dtype=self.matrix.indices.dtype), np.empty(0, dtype=self.matrix.dtype)
+        start, stop = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        return self.matrix.indices[start:stop], self.matrix.data[start:stop]
+
+    def totals(self, symptom_ids):
+        """
+        Returns the per-remedy occurrence counts and degree sums of the given symptoms
+        as two dense arrays over all remedies.
+        """
+        selected = self.matrix[self.rows_of(symptom_ids)]
+        occurrences = selected.getnnz(axis=0).astype(np.int64)
+        degrees = np.asarray(selected.sum(axis=0)).ravel()
+        return occurrences, degrees
+
+    def score(self, symptom_ids):
+        """
+        Ranks the remedies of the given symptoms.
+
+        Parameters:
+        - symptom_ids (list of int): The IDs of the selected symptoms.
+
+        Returns:
+        - DataFrame with 'abbreviation', 'description', 'total_occurrence' and 'total_degree'
+          of every remedy of the symptoms, sorted by occurrence and then degree, descending.
+        """
+        occurrences, degrees = self.totals(symptom_ids)
+        return self.ranking(occurrences, degrees)
+
+    def ranking(self, occurrences, degrees):
+        """
+        Builds the ranked remedy table from per-remedy occurrence counts and degree sums.
+        """
+        remedies = np.flatnonzero(occurrences)
+        # lexsort sorts by the last key first
+        order = remedies[np.lexsort((-degrees[remedies], -occurrences[remedies]))]
+        return pd.DataFrame({
+            'abbreviation': self.abbreviations[order],
+            'description': self.descriptions[order],
+            'total_occurrence': occurrences[order],
+            'total_degree': degrees[order],
+        })
+
+
+def load_remedy_matrix(db_path='synthesis.db', version=None):
+    """
+    Loads symptom_remedies from the database into a RemedyMatrix.
+
+    Parameters:
+    - db_path (str): Path to the SQLite database file.
+    - version: Version of the database file the matrix is loaded from.
+
+    Returns:
+    - RemedyMatrix with one row per symptom and one column per remedy.
+    """
+    pool = get_pool(db_path)
+    with pool.connection() as conn:
+        links = pd.read_sql_query(remedies_query(details=pool.has_table(REMEDY_DETAILS_TABLE)), conn)
+
+    symptom_ids, rows = np.unique(links['symptom_id'].to_numpy(), return_inverse=True)
+    abbreviations, columns = np.unique(links['remedy_abbreviation'].to_numpy(dtype=object), return_inverse=True)
+    descriptions = (
+        links.drop_duplicates('remedy_abbreviation')
+        .set_index('remedy_abbreviation')['description']
+        .reindex(abbreviations)
+        .to_numpy(dtype=object)
+    )
+    matrix = sparse.csr_matrix(
+        (links['degree'].to_numpy(), (rows, columns)),
+        shape=(len(symptom_ids), len(abbreviations))
+    )
+    matrix.sum_duplicates()
+    return RemedyMatrix(symptom_ids, abbreviations, descriptions, matrix, version)
+
+
+class RemedyAccumulator:
+    """
+    Per-session running totals of the remedies of all included symptoms.
+
+    Including or excluding a symptom adds or subtracts its row of the RemedyMatrix,
+    so every checkbox toggle costs one sparse row; the final table is read straight
+    from the maintained totals.
+    """
+
+    def __init__(self):
+        # dict used as an ordered set of the included symptom ids
+        self.symptom_ids = {}
+        self.version = None
+        self.occurrences = None
+        self.degrees = None
+
+    def __len__(self):
+        return len(self.symptom_ids)
+
+    def __contains__(self, symptom_id):
+        return symptom_id in self.symptom_ids
+
+    def _sync(self, remedy_matrix):
+        # Totals of another database version are recomputed from the included symptoms
+        if self.version != remedy_matrix.version or self.occurrences is None:
+            self.occurrences, self.degrees = remedy_matrix.totals(self.symptom_ids)
+            self.version = remedy_matrix.version
+
+    def include(self, symptom_id, remedy_matrix):
+        """
+        Adds the remedies of a symptom to the totals.
+        """
+        self._sync(remedy_matrix)
+        if symptom_id in self.symptom_ids:
+            return
+        self.symptom_ids[symptom_id] = None
+        columns, degrees = remedy_matrix.row_entries(symptom_id)
+        self.occurrences[columns] += 1
+        self.degrees[columns] += degrees
+
+    def exclude(self, symptom_id, remedy_matrix):
+        """
+        Removes the remedies of a symptom from the totals.
+        """
+        self._sync(remedy_matrix)
+        if symptom_id not in self.symptom_ids:
+            return
+        del self.symptom_ids[symptom_id]
+        columns, degrees = remedy_matrix.row_entries(symptom_id)
+        self.occurrences[columns] -= 1
+        self.degrees[columns] -= degrees
+
+    def table(self, remedy_matrix):
+        """
+        Returns the ranked remedy table of the included symptoms, see RemedyMatrix.ranking.
+        """
+        self._sync(remedy_matrix)
+        return remedy_matrix.ranking(self.occurrences, self.degrees)
@@ -0,0 +1,80 @@
+# s3_sync.py
+
+import os
+import re
+import tempfile
+
+
+def remote_etag(s3_client, bucket_name, s3_key):
+    """
+    Returns the ETag of an S3 object without downloading it.
+    """
+    response = s3_client.head_object(Bucket=bucket_name, Key=s3_key)
+    return response['ETag'].strip('"')
+
+
+def version_name(etag):
+    """
+    Returns a file system safe version name for an ETag.
+    """
+    return re.sub(r'[^A-Za-z0-9_-]', '_', etag)
+
+
+def local_version(local_filename):
+    """
+    Returns the ETag of the S3 object the local file was synced from, or None.
+    """
+    try:
+        with open(f'{local_filename}.etag', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def sync_s3_file(s3_client, bucket_name, s3_key, local_filename, validate=None):
+    """
+    Makes local_filename a copy of an S3 object, downloading it only when its ETag changed.
+
+    The object is downloaded to a temporary file next to local_filename, validated and
+    atomically renamed into place, so readers never see a half-written file. The ETag
+    is stored in the sidecar file local_filename.etag.
+
+    Parameters:
+    - s3_client: boto3 S3 client.
+    - bucket_name (str): Bucket of the object.
+    - s3_key (str): Key of the object.
+    - local_filename (str): Path of the local copy.
+    - validate (callable): Called with the temporary file, raises if it is not usable.
+
+    Returns:
+    - The ETag of the local copy.
+    """
+    try:
+        etag = remote_etag(s3_client, bucket_name, s3_key)
+    except Exception:
+        # Keep using the local copy when S3 is not reachable
+        if os.path.exists(local_filename):
+            return local_version(local_filename)
+        raise
+
+    if os.path.exists(local_filename) and local_version(local_filename) == etag:
+        return etag
+
+    directory = os.path.dirname(os.path.abspath(local_filename))
+    fd, temporary_path = tempfile.mkstemp(prefix=f'.{os.path.basename(local_filename)}.', dir=directory)
+    os.close(fd)
+    try:
+        s3_client.download_file(bucket_name, s3_key, temporary_path)
+        if validate is not None:
+            validate(temporary_path)
+        os.replace(temporary_path, local_filename)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    version_path = f'{local_filename}.etag'
+    with open(f'{version_path}.{os.getpid()}.tmp', 'w', encoding='utf-8') as f:
+        f.write(etag)
+    os.replace(f'{version_path}.{os.getpid()}.tmp', version_path)
+    return etag
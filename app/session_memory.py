@@ -0,0 +1,174 @@
+# session_memory.py
+
+import os
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from conversation import trim_history, TOKEN_BUDGET
+from metrics import emit, increment, set_gauge, current_session_id
+
+# Bytes of session state one session may hold before large entries are evicted or compacted
+SESSION_MEMORY_BUDGET = int(os.environ.get('Z_SESSION_MEMORY_BUDGET', 4 * 1024 * 1024))
+
+# Seconds after its last rerun a session no longer counts towards the process footprint
+SESSION_IDLE_SECONDS = int(os.environ.get('Z_SESSION_IDLE_SECONDS', 3600))
+
+# Number of sessions whose footprint is tracked, the least recently active are dropped first
+MAX_TRACKED_SESSIONS = 10000
+
+# Session id -> (bytes, time of the last measurement)
+_footprints = OrderedDict()
+_footprints_lock = threading.Lock()
+
+
+def footprint(value, seen=None):
+    """
+    Estimates the number of bytes reachable from value.
+
+    Objects shared with process-wide caches, e.g. remedy lists of the remedy cache, are
+    counted as well, so the result is an upper bound of what the session alone holds.
+
+    Parameters:
+    - value: Any session state value.
+    - seen (set): Ids of the objects already counted, shared between calls to count
+      every object once.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(footprint(key, seen) + footprint(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(footprint(item, seen) for item in value)
+    elif hasattr(value, '__dict__') and not callable(value) and not isinstance(value, types.ModuleType):
+        # e.g. the RemedyAccumulator or the future of the speculative search
+        size += footprint(vars(value), seen)
+    return size
+
+
+def measure_session(state):
+    """
+    Returns a dict mapping each session state key to the bytes it holds.
+    """
+    seen = set()
+    return {key: footprint(state[key], seen) for key in list(state.keys())}
+
+
+def _eviction_plan(state, sizes):
+    """
+    Yields (key, action) pairs in the order entries are evicted or compacted: first
+    what is cheapest to restore, largest entries first within each group.
+    """
+    def by_size(keys):
+        return sorted(keys, key=lambda key: sizes.get(key, 0), reverse=True)
+
+    selected_rows = state.get('selected_rows')
+    selected = set()
+    if isinstance(selected_rows, pd.DataFrame) and 'id' in selected_rows:
+        selected = {f'remedies_{symptom_id}' for symptom_id in selected_rows['id']}
+    remedy_keys = [key for key in sizes if key.startswith('remedies_')]
+
+    def delete(key):
+        return lambda: state.pop(key, None)
+
+    # 1. remedies of symptoms that are no longer selected
+    for key in by_size(key for key in remedy_keys if key not in selected):
+        yield key, delete(key)
+
+    # 2. turns of the conversation that no request sends any more
+    if 'conversation' in sizes:
+        def compact_conversation():
+            state['conversation'] = trim_history(state['conversation'], TOKEN_BUDGET)
+        yield 'conversation', compact_conversation
+
+    # 3. search results outside the search step, the search runs again if needed
+    if 'top_results' in sizes and state.get('current_step') != 'search':
+        def drop_top_results():
+            state['top_results'] = pd.DataFrame()
+            state.pop('search_performed', None)
+        yield 'top_results', drop_top_results
+
+    # 4. result sets of a case outside the case intake step
+    if 'case_results' in sizes and state.get('current_step') != 'case_intake':
+        yield 'case_results', delete('case_results')
+
+    # 5. remedies of the selected symptoms, display_remedies reads them again from the remedy cache
+    for key in by_size(key for key in remedy_keys if key in selected):
+        yield key, delete(key)
+
+
+def enforce_session_budget(state, budget=SESSION_MEMORY_BUDGET):
+    """
+    Measures the session state and evicts or compacts large entries until it fits
+    into budget bytes. The footprint is tracked per session for the process totals.
+
+    Parameters:
+    - state: The session state, e.g. st.session_state.
+    - budget (int): Budget of the session in bytes.
+
+    Returns:
+    - Tuple (bytes held after enforcing the budget, list of evicted or compacted keys).
+    """
+    sizes = measure_session(state)
+    total = sum(sizes.values())
+    before = total
+    evicted = []
+    if total > budget:
+        for key, action in _eviction_plan(state, sizes):
+            if total <= budget:
+                break
+            action()
+            size = footprint(state[key]) if key in state else 0
+            if size < sizes.get(key, 0):
+                total -= sizes[key] - size
+                evicted.append(key)
+                increment('session_memory_evictions', entry='remedies' if key.startswith('remedies_') else key)
+            sizes[key] = size
+
+    session_id = current_session_id()
+    if session_id is not None:
+        _track(session_id, total)
+    if evicted:
+        emit({'type': 'session_memory', 'session': session_id, 'bytes_before': before,
+              'bytes': total, 'budget': budget, 'evicted': evicted})
+    return total, evicted
+
+
+def _track(session_id, total):
+    now = time.time()
+    with _footprints_lock:
+        _footprints.pop(session_id, None)
+        _footprints[session_id] = (total, now)
+        # the dict is ordered by activity, drop idle sessions from the front
+        while _footprints and (
+            len(_footprints) > MAX_TRACKED_SESSIONS
+            or next(iter(_footprints.values()))[1] < now - SESSION_IDLE_SECONDS
+        ):
+            _footprints.popitem(last=False)
+        sessions, total_bytes = len(_footprints), sum(size for size, _ in _footprints.values())
+    set_gauge('sessions_active', sessions)
+    set_gauge('session_memory_bytes', total_bytes)
+
+
+def process_footprint():
+    """
+    Returns the number of sessions active within SESSION_IDLE_SECONDS and the bytes
+    of session state they hold together.
+    """
+    with _footprints_lock:
+        cutoff = time.time() - SESSION_IDLE_SECONDS
+        active = [size for size, seen_at in _footprints.values() if seen_at >= cutoff]
+    return len(active), sum(active)
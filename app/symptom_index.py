@@ -0,0 +1,327 @@
+# symptom_index.py
+
+import os
+from contextlib import nullcontext
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # threadpoolctl is optional, without it BLAS keeps its own default
+    threadpool_limits = None
+
+# Number of rows copied per block when building the matrix, keeps temporaries small
+BUILD_BLOCK_ROWS = 65536
+
+# Number of rows dequantized and scored per block when scanning a compact matrix
+SCAN_BLOCK_ROWS = 16384
+
+# Number of candidates per query rescored at full precision after a compact scan
+DEFAULT_RESCORE_CANDIDATES = 300
+
+# Default number of BLAS threads used for scoring, None keeps the BLAS default
+DEFAULT_BLAS_THREADS = int(os.environ['Z_BLAS_THREADS']) if os.environ.get('Z_BLAS_THREADS') else None
+
+
+class SymptomIndex:
+    """
+    Process-resident symptom embedding index.
+
+    All rows are sorted by category, so every category is one contiguous slice of
+    a single normalized float32 matrix. A search is one slice plus one matmul.
+    """
+
+    def __init__(self, ids, categories, paths, matrix, category_ranges):
+        self.ids = ids
+        self.categories = categories
+        self.paths = paths
+        self.matrix = matrix
+        self.category_ranges = category_ranges
+        # Optional approximate nearest-neighbour backend, see ann_index.py
+        self.ann = None
+        # Optional compact copy of the matrix that is scanned instead of it, see quantize_matrix
+        self.compact = None
+        self.rescore_candidates = DEFAULT_RESCORE_CANDIDATES
+        # Optional inverted n-gram index and BM25 index over the paths, see text_index.py
+        self.text_index = None
+        self.lexical = None
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def dimensions(self):
+        return self.matrix.shape[1]
+
+    def category_slice(self, category=None):
+        """
+        Returns the row slice of a category, the full index for None and an empty
+        slice for unknown categories.
+        """
+        if category is None:
+            return slice(0, len(self))
+        start, stop = self.category_ranges.get(category, (0, 0))
+        return slice(start, stop)
+
+    def search(self, query_embedding, category=None, top_n=10, exact=False):
+        """
+        Searches the top_n most similar symptoms of one category.
+
+        Parameters:
+        - query_embedding (list or np.ndarray): Embedding of the search query.
+        - category (str): Category to search in, None searches the whole index.
+        - top_n (int): Number of results to return.
+        - exact (bool): Search exactly even if an approximate backend is attached.
+
+        Returns:
+        - DataFrame with 'id', 'category', 'path' and 'similarity' columns.
+        """
+        row_indices, scores = self.score_top_k([query_embedding], category=category, top_n=top_n, exact=exact)
+        return self.to_frame(row_indices[0], scores[0])
+
+    def search_batch(self, query_embeddings, category=None, top_n=10, blas_threads=DEFAULT_BLAS_THREADS, exact=False):
+        """
+        Searches the top_n most similar symptoms of one category for a batch of queries.
+
+        Parameters:
+        - query_embeddings (list or np.ndarray): One embedding per query.
+        - category (str): Category to search in, None searches the whole index.
+        - top_n (int): Number of results per query.
+        - blas_threads (int): Number of BLAS threads used for scoring, None keeps the default.
+        - exact (bool): Search exactly even if an approximate backend is attached.
+
+        Returns:
+        - Tuple (ids, scores) of arrays with shape (queries, top_n), best match first.
+        """
+        row_indices, scores = self.score_top_k(query_embeddings, category, top_n, blas_threads, exact)
+        return self.ids[row_indices], scores
+
+    def score_top_k(self, query_embeddings, category=None, top_n=10, blas_threads=DEFAULT_BLAS_THREADS, exact=False):
+        """
+        Scores all queries against a category slice with a single matrix product and
+        returns the global row indices and scores of the top_n rows per query.
+
+        Categories covered by the approximate backend are searched there unless exact is set.
+        """
+        if not exact and self.ann is not None and self.ann.covers(category):
+            return self.ann.score_top_k(query_embeddings, category, top_n, blas_threads=blas_threads)
+        rows = self.category_slice(category)
+        queries = normalize_rows(np.array(query_embeddings, dtype=np.float32, ndmin=2))
+        with limit_blas_threads(blas_threads):
+            if self.compact is not None:
+                return self._scan_compact(queries, rows, top_n)
+            # calculate cosine similarities of all queries in one GEMM
+            cosine_similarities = queries @ self.matrix[rows].T
+        top_indices = top_k(cosine_similarities, top_n)
+        top_scores = np.take_along_axis(cosine_similarities, top_indices, axis=1)
+        return rows.start + top_indices, top_scores
+
+    def _scan_compact(self, queries, rows, top_n):
+        # Scan the compact matrix for a shortlist, then rescore it at full precision
+        approximate = self.compact.scores(queries, rows)
+        shortlist = rows.start + top_k(approximate, max(top_n, self.rescore_candidates))
+        top_n = min(top_n, shortlist.shape[1])
+        row_indices = np.empty((len(queries), top_n), dtype=np.int64)
+        scores = np.empty((len(queries), top_n), dtype=np.float32)
+        for i, query in enumerate(queries):
+            exact_scores = np.asarray(self.matrix[shortlist[i]], dtype=np.float32) @ query
+            best = top_k(exact_scores, top_n)[0]
+            row_indices[i] = shortlist[i][best]
+            scores[i] = exact_scores[best]
+        return row_indices, scores
+
+    def rank_rows(self, query_embedding, row_indices, top_n=None):
+        """
+        Scores the given global rows against one query and returns them best first.
+
+        Returns:
+        - DataFrame with 'id', 'category', 'path' and 'similarity' columns.
+        """
+        query = normalize_rows(np.array(query_embedding, dtype=np.float32, ndmin=2))[0]
+        scores = np.asarray(self.matrix[row_indices], dtype=np.float32) @ query
+        best = top_k(scores, len(scores) if top_n is None else top_n)[0]
+        return self.to_frame(np.asarray(row_indices)[best], scores[best])
+
+    def to_frame(self, row_indices, scores):
+        """
+        Builds the result DataFrame for the given global row indices.
+        """
+        return pd.DataFrame({
+            'id': self.ids[row_indices],
+            'category': self.categories[row_indices],
+            'path': self.paths[row_indices],
+            'similarity': scores,
+        })
+
+
+class CompactMatrix:
+    """
+    Compact copy of a normalized embedding matrix, either float16 or int8 codes
+    with one float32 scale per row.
+    """
+
+    def __init__(self, codes, scales=None):
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def scores(self, queries, rows):
+        """
+        Returns the approximate scores of all queries against the given row slice,
+        dequantizing one block of rows at a time.
+        """
+        scores = np.empty((len(queries), rows.stop - rows.start), dtype=np.float32)
+        for start in range(rows.start, rows.stop, SCAN_BLOCK_ROWS):
+            stop = min(start + SCAN_BLOCK_ROWS, rows.stop)
+            block = queries @ self.codes[start:stop].astype(np.float32).T
+            if self.scales is not None:
+                block *= self.scales[start:stop]
+            scores[:, start - rows.start:stop - rows.start] = block
+        return scores
+
+
+def quantize_matrix(matrix, mode):
+    """
+    Returns a CompactMatrix of matrix in the given mode ('float16' or 'int8').
+    """
+    if mode == 'float16':
+        return CompactMatrix(matrix.astype(np.float16))
+    if mode != 'int8':
+        raise ValueError(f"Unknown embedding storage mode: {mode}")
+    codes = np.empty(matrix.shape, dtype=np.int8)
+    scales = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), BUILD_BLOCK_ROWS):
+        block = np.asarray(matrix[start:start + BUILD_BLOCK_ROWS], dtype=np.float32)
+        block_scales = np.maximum(np.abs(block).max(axis=1), np.finfo(np.float32).tiny) / 127
+        codes[start:start + len(block)] = np.rint(block / block_scales[:, None])
+        scales[start:start + len(block)] = block_scales
+    return CompactMatrix(codes, scales)
+
+
+def top_k(scores, k):
+    """
+    Returns the column indices of the k highest scores of every row, best first.
+
+    Uses a partial sort, so only the k selected entries are sorted.
+    """
+    scores = np.atleast_2d(scores)
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.intp)
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(k), (scores.shape[0], k))
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def limit_blas_threads(threads):
+    """
+    Returns a context limiting the number of BLAS threads, a no-op without threadpoolctl.
+    """
+    if threads is None or threadpool_limits is None:
+        return nullcontext()
+    return threadpool_limits(limits=threads, user_api='blas')
+
+
+def normalize_rows(matrix):
+    """
+    Normalizes the rows of a float matrix to unit length in place and returns it.
+    """
+    norms = np.sqrt(np.einsum('ij,ij->i', matrix, matrix))
+    matrix /= np.maximum(norms, np.finfo(matrix.dtype).tiny)[:, None]
+    return matrix
+
+
+def embeddings_from_arrow(column):
+    """
+    Returns a (rows, dimensions) view on the values of an Arrow list column.
+
+    Fixed size list columns are viewed without copying; variable size list columns
+    are flattened and must have the same length in every row.
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if pa.types.is_fixed_size_list(column.type):
+        dimensions = column.type.list_size
+    else:
+        lengths = pc.list_value_length(column)
+        dimensions = pc.min(lengths).as_py()
+        if dimensions != pc.max(lengths).as_py():
+            raise ValueError("All path_embeddings must have the same number of dimensions.")
+    values = column.flatten().to_numpy(zero_copy_only=False)
+    return values.reshape(len(column), dimensions)
+
+
+def build_symptom_index(table):
+    """
+    Builds a SymptomIndex from the symptom table.
+
+    Parameters:
+    - table (pa.Table or DataFrame): Table with 'id', 'category', 'path' and 'path_embeddings'.
+
+    Returns:
+    - SymptomIndex with rows sorted by category.
+    """
+    if isinstance(table, pd.DataFrame):
+        table = pa.Table.from_pandas(table, preserve_index=False)
+
+    ids = table.column('id').to_numpy()
+    categories = np.asarray(table.column('category').fill_null('').to_pylist(), dtype=object)
+    paths = np.asarray(table.column('path').fill_null('').to_pylist(), dtype=object)
+    embeddings = embeddings_from_arrow(table.column('path_embeddings'))
+
+    # sort all rows by category so each category becomes one contiguous slice
+    order = np.argsort(categories, kind='stable')
+    ids, categories, paths = ids[order], categories[order], paths[order]
+
+    # copy the embeddings block wise into one contiguous float32 matrix
+    matrix = np.empty(embeddings.shape, dtype=np.float32)
+    for start in range(0, len(order), BUILD_BLOCK_ROWS):
+        block = order[start:start + BUILD_BLOCK_ROWS]
+        matrix[start:start + len(block)] = embeddings[block]
+        normalize_rows(matrix[start:start + len(block)])
+
+    return SymptomIndex(ids, categories, paths, matrix, compute_category_ranges(categories))
+
+
+def compute_category_ranges(sorted_categories):
+    """
+    Returns a dict mapping each category to its (start, stop) row range.
+    """
+    if len(sorted_categories) == 0:
+        return {}
+    boundaries = np.flatnonzero(sorted_categories[1:] != sorted_categories[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    stops = np.concatenate((boundaries, [len(sorted_categories)]))
+    return {
+        sorted_categories[start]: (int(start), int(stop))
+        for start, stop in zip(starts, stops)
+    }
+
+
+def resolve_category(llm_oberkategorie, llm_unterkategorie):
+    """
+    Returns the category to search in: the Unterkategorie for 'Körper', the Oberkategorie otherwise.
+    """
+    if llm_oberkategorie == 'Körper':
+        return llm_unterkategorie
+    return llm_oberkategorie
+
+
+def path_category(suchpfad, category_ranges):
+    """
+    Returns the category named by a Suchpfad, e.g. 'Kopf' for 'Kopf - Schmerz - morgens',
+    or None if the index has no such category. As in resolve_category, the second
+    segment names the category of a 'Körper' path, e.g. 'Schlaf' for
+    'Körper - Schlaf - Erwachen'.
+    """
+    segments = [segment.strip() for segment in suchpfad.split('-', 2)]
+    category = resolve_category(segments[0], segments[1] if len(segments) > 1 else None)
+    return category if category in category_ranges else None
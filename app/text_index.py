@@ -0,0 +1,230 @@
+# text_index.py
+
+import re
+from itertools import chain
+import numpy as np
+from scipy import sparse
+from symptom_index import top_k, normalize_rows
+
+# Length of the n-grams in the inverted index
+NGRAM = 3
+
+# BM25 term frequency saturation and length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Ranks considered per ranking and rank offset of the reciprocal rank fusion
+RRF_DEPTH = 200
+RRF_K = 60
+
+TOKEN = re.compile(r'\w+')
+
+
+def fold(text):
+    """
+    Case-folds text for case-insensitive matching.
+    """
+    return text.casefold()
+
+
+def tokenize(text):
+    """
+    Returns the case-folded word tokens of text.
+    """
+    return TOKEN.findall(fold(text))
+
+
+def ngrams(text):
+    """
+    Returns the set of character n-grams of an already folded text.
+    """
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+def build_postings(texts):
+    """
+    Returns the posting lists of already folded texts as three arrays: the sorted
+    n-grams, the offsets of their lists and the concatenated rows, so the rows
+    containing grams[i] are rows[offsets[i]:offsets[i + 1]].
+    """
+    postings = {}
+    for row, text in enumerate(texts):
+        for gram in ngrams(text):
+            postings.setdefault(gram, []).append(row)
+    grams = sorted(postings)
+    offsets = np.zeros(len(grams) + 1, dtype=np.int64)
+    np.cumsum([len(postings[gram]) for gram in grams], out=offsets[1:])
+    # rows are appended in order, so every posting list is sorted
+    rows = np.fromiter(chain.from_iterable(postings[gram] for gram in grams), dtype=np.int32, count=int(offsets[-1]))
+    return np.asarray(grams, dtype=f'<U{NGRAM}'), offsets, rows
+
+
+class NgramIndex:
+    """
+    Case-folded character trigram inverted index over the symptom paths.
+
+    A keyword resolves to the intersection of the posting lists of its trigrams;
+    the candidates are then verified with a substring test, so the result equals a
+    case-insensitive substring filter over all rows.
+
+    The posting lists are three flat arrays, so the store can keep them on disk and
+    memory-map them instead of building them in every process, see embedding_store.
+    """
+
+    def __init__(self, texts, postings=None):
+        self.texts = [fold(text) for text in texts]
+        if postings is None:
+            postings = build_postings(self.texts)
+        self.grams, self.offsets, self.rows = postings
+
+    def posting(self, gram):
+        """
+        Returns the sorted rows whose text contains gram, or None.
+        """
+        i = int(np.searchsorted(self.grams, gram))
+        if i == len(self.grams) or self.grams[i] != gram:
+            return None
+        return self.rows[self.offsets[i]:self.offsets[i + 1]]
+
+    def rows_containing(self, keyword, rows):
+        """
+        Returns the sorted rows of the given row range whose text contains keyword.
+
+        Parameters:
+        - keyword (str): The keyword, matched case-insensitively as a substring.
+        - rows (slice): Row range to search in.
+        """
+        keyword = fold(keyword.strip())
+        grams = ngrams(keyword)
+        if not grams:
+            # Keywords shorter than an n-gram are matched by scanning the range
+            return np.asarray(
+                [row for row in range(rows.start, rows.stop) if keyword in self.texts[row]],
+                dtype=np.int32
+            )
+        # Intersect the shortest posting lists first
+        lists = sorted((self.posting(gram) for gram in grams), key=lambda l: 0 if l is None else len(l))
+        if lists[0] is None:
+            return np.empty(0, dtype=np.int32)
+        candidates = lists[0]
+        candidates = candidates[np.searchsorted(candidates, rows.start):np.searchsorted(candidates, rows.stop)]
+        for posting in lists[1:]:
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+            if len(candidates) == 0:
+                break
+        return np.asarray([row for row in candidates if keyword in self.texts[row]], dtype=np.int32)
+
+    def rows_containing_all(self, keywords, rows):
+        """
+        Returns the sorted rows of the given row range whose text contains all keywords.
+        """
+        matches = None
+        # Longer keywords have shorter posting lists, resolve them first
+        for keyword in sorted(keywords, key=len, reverse=True):
+            if matches is None:
+                matches = self.rows_containing(keyword, rows)
+            elif len(fold(keyword.strip())) < NGRAM:
+                folded = fold(keyword.strip())
+                matches = np.asarray([row for row in matches if folded in self.texts[row]], dtype=np.int32)
+            else:
+                matches = np.intersect1d(matches, self.rows_containing(keyword, rows), assume_unique=True)
+            if len(matches) == 0:
+                break
+        if matches is None:
+            return np.arange(rows.start, rows.stop, dtype=np.int32)
+        return matches
+
+
+class BM25Index:
+    """
+    BM25 over the symptom paths as a sparse document x term matrix.
+
+    The BM25 weight of every (path, term) pair is precomputed, so scoring a batch of
+    queries against a row range is one sparse matrix product.
+    """
+
+    def __init__(self, texts, k1=BM25_K1, b=BM25_B):
+        self.vocabulary = {}
+        rows, columns = [], []
+        for row, text in enumerate(texts):
+            for token in tokenize(text):
+                rows.append(row)
+                columns.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = np.asarray(columns, dtype=np.int64)
+        shape = (len(texts), len(self.vocabulary))
+
+        # duplicate (row, term) pairs are summed into term frequencies
+        tf = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=shape)
+        tf.sum_duplicates()
+        lengths = np.bincount(rows, minlength=shape[0]).astype(np.float32)
+        average_length = max(lengths.mean(), 1.0) if len(lengths) else 1.0
+        document_frequency = np.bincount(tf.indices, minlength=shape[1])
+        idf = np.log1p((shape[0] - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+
+        row_of_entry = np.repeat(np.arange(shape[0]), np.diff(tf.indptr))
+        norm = k1 * (1 - b + b * lengths[row_of_entry] / average_length)
+        tf.data = idf[tf.indices] * tf.data * (k1 + 1) / (tf.data + norm)
+        self.weights = tf
+
+    def query_matrix(self, queries):
+        """
+        Returns the sparse query x term matrix of the query texts; unknown terms are dropped.
+        """
+        rows, columns = [], []
+        for row, query in enumerate(queries):
+            for token in tokenize(query):
+                if token in self.vocabulary:
+                    rows.append(row)
+                    columns.append(self.vocabulary[token])
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, columns)),
+            shape=(len(queries), len(self.vocabulary))
+        )
+
+    def scores(self, queries, rows):
+        """
+        Returns the dense (queries, rows) BM25 scores of the query texts against a row range.
+        """
+        return np.asarray((self.query_matrix(queries) @ self.weights[rows.start:rows.stop].T).todense())
+
+
+def hybrid_score_top_k(index, query_texts, query_embeddings, category=None, top_n=10, depth=RRF_DEPTH, rrf_k=RRF_K):
+    """
+    Ranks the rows of a category by reciprocal rank fusion of the embedding ranking
+    and the BM25 ranking of index.lexical.
+
+    Both rankings are computed for the whole batch at once, only their best depth
+    rows take part in the fusion.
+
+    Parameters:
+    - index (SymptomIndex): The symptom index with a BM25Index as index.lexical.
+    - query_texts (list of str): The query texts.
+    - query_embeddings (list or np.ndarray): One embedding per query.
+    - category (str): Category to search in, None searches the whole index.
+    - top_n (int): Number of results per query.
+    - depth (int): Number of rows of each ranking taken into the fusion.
+    - rrf_k (int): Rank offset of the fusion.
+
+    Returns:
+    - Tuple (row_indices, similarities) per query, ordered by the fused rank; the
+      similarities are the cosine similarities of the rows.
+    """
+    rows = index.category_slice(category)
+    vector_rows, _ = index.score_top_k(query_embeddings, category, top_n=max(depth, top_n))
+    lexical_scores = index.lexical.scores(query_texts, rows)
+    lexical_rows = rows.start + top_k(lexical_scores, max(depth, top_n))
+    queries = normalize_rows(np.array(query_embeddings, dtype=np.float32, ndmin=2))
+
+    results = []
+    for i, query in enumerate(queries):
+        # rows without any matching term are not part of the lexical ranking
+        matched = lexical_scores[i, lexical_rows[i] - rows.start] > 0
+        fused = {}
+        for ranking in (vector_rows[i], lexical_rows[i][matched]):
+            for rank, row in enumerate(ranking):
+                fused[row] = fused.get(row, 0.0) + 1.0 / (rrf_k + rank + 1)
+        best = np.asarray(sorted(fused, key=fused.get, reverse=True)[:top_n], dtype=np.int64)
+        similarities = np.asarray(index.matrix[best], dtype=np.float32) @ query
+        results.append((best, similarities))
+    return results
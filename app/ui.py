@@ -1,7 +1,8 @@
 import streamlit as st
 from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode
-from helpers import get_remedies, partial_reset_session_state, full_reset_session_state, add_to_final_results, remove_from_final_results
+from helpers import get_remedy_matrix, partial_reset_session_state, full_reset_session_state, add_to_final_results, remove_from_final_results
 import pandas as pd
+from pipeline import discard_speculative_search, get_remedies_cached
 
 def get_input_symptom_class():
     st.title("Symptom Analyse")
@@ -14,12 +15,16 @@ def get_input_symptom_class():
         if user_input:
             st.session_state.current_step = 'processing_symptom_class'
             st.session_state.user_input_symptom_class = user_input
-            # the user input to st.session_state.conversation
-            st.session_state.conversation.append({"role": "user", "content": f"User Input: {st.session_state.user_input_symptom_class}"})
+            # the user input is added to the conversation together with the response
             st.rerun()
         else:
             st.warning("Bitte geben Sie die Symptomklasse des Patienten ein.")
 
+    # Search several Suchpfade of a case at once instead
+    if st.button("Fallaufnahme mit mehreren Suchpfaden"):
+        st.session_state.current_step = 'case_intake'
+        st.rerun()
+
 
 
 def display_symptom_class_results():
@@ -70,6 +75,8 @@ def display_symptom_class_results():
     # Display Begründung in its own section with bold heading
     st.markdown("**Begründung**")
     st.write(begründung)
+    if 'prompt_tokens' in st.session_state:
+        st.caption(f"Anfrage: {st.session_state.prompt_tokens} Tokens")
 
     # Add another separator
     st.markdown("---")
@@ -91,8 +98,8 @@ def display_symptom_class_results():
         # Button to submit feedback
         if st.button("Anpassungen einreichen"):
             if user_feedback:
-                # Append the user's feedback to the conversation
-                st.session_state.conversation.append({"role": "user", "content": user_feedback})
+                # The background search was started for the rejected Suchpfad
+                discard_speculative_search()
                 # Update the user input in session state
                 st.session_state.user_input_symptom_class = user_feedback
                 # Clear previous outputs if necessary
@@ -122,8 +129,8 @@ def adjust_symptom_class():
         if user_input:
             # Update the user input in session state
             st.session_state.user_input_symptom_class = user_input
-            # Append the new input to the conversation
-            st.session_state.conversation.append({"role": "user", "content": user_input})
+            # The background search was started for the rejected Suchpfad
+            discard_speculative_search()
             # Clear previous outputs if necessary
             st.session_state.oberkategorie = ''
             st.session_state.unterkategorie = ''
@@ -150,6 +157,15 @@ def display_remedies():
     selected_rows = st.session_state.selected_rows
 
     if selected_rows is not None and not selected_rows.empty:
+        # Read the remedies of all symptoms not fetched yet from the prefetched remedy cache
+        missing_ids = [
+            symptom_id for symptom_id in selected_rows['id']
+            if f'remedies_{symptom_id}' not in st.session_state
+        ]
+        if missing_ids:
+            for symptom_id, remedies in get_remedies_cached(missing_ids).items():
+                st.session_state[f'remedies_{symptom_id}'] = remedies
+
         for i, row in selected_rows.iterrows():
             symptom_id = row['id']
             symptom_text = row['path']
@@ -164,12 +180,8 @@ def display_remedies():
             if expanded_key not in st.session_state:
                 st.session_state[expanded_key] = False  # Default is collapsed
 
-            # Fetch remedies and store in session state if not already fetched
-            if remedies_key not in st.session_state:
-                remedies = get_remedies(symptom_id)
-                st.session_state[remedies_key] = remedies
-            else:
-                remedies = st.session_state[remedies_key]
+            # Remedies were fetched above
+            remedies = st.session_state[remedies_key]
 
             # Initialize inclusion flag in session state
             if include_key not in st.session_state:
@@ -186,7 +198,7 @@ def display_remedies():
                 # Inclusion state has changed
                 if st.session_state[include_key]:
                     # Checkbox is checked, add remedies
-                    add_to_final_results(remedies, symptom_id)
+                    add_to_final_results(symptom_id)
                 else:
                     # Checkbox is unchecked, remove remedies
                     remove_from_final_results(symptom_id)
@@ -247,24 +259,11 @@ def display_final_analysis():
     st.header("Finales Analyse Ergebnis")
 
     # Retrieve the final results from session state
-    final_results = st.session_state.get('final_results', [])
+    final_results = st.session_state.get('final_results')
 
     if final_results:
-        # Convert the list of dictionaries to a DataFrame
-        final_df = pd.DataFrame(final_results)
-
-        # Aggregate remedies by abbreviation
-        aggregated_df = final_df.groupby('abbreviation').agg(
-            total_occurrence=pd.NamedAgg(column='abbreviation', aggfunc='count'),
-            total_degree=pd.NamedAgg(column='degree', aggfunc='sum')
-        ).reset_index()
-
-        # Merge with descriptions to retain remedy descriptions
-        descriptions = final_df[['abbreviation', 'description']].drop_duplicates()
-        aggregated_df = pd.merge(aggregated_df, descriptions, on='abbreviation', how='left')
-
-        # Rearrange columns for clarity
-        aggregated_df = aggregated_df[['abbreviation', 'description', 'total_occurrence', 'total_degree']]
+        # Read the table straight from the running totals of the included symptoms
+        aggregated_df = final_results.table(get_remedy_matrix())
 
         #rename columns 'Kürzel', 'Mittel', 'Summe Symptom', 'Summe Wertigkeit'
         aggregated_df.rename(columns={
@@ -274,8 +273,7 @@ def display_final_analysis():
             'total_degree': 'Summe Wertigkeit'
         }, inplace=True)
 
-        # Sort by 'Summe Symptom' and then by 'Summe Wertigkeit' both in descending order
-        aggregated_df.sort_values(by=['Summe Symptom', 'Summe Wertigkeit'], ascending=[False, False], inplace=True)
+        # Rows are already sorted by 'Summe Symptom' and then by 'Summe Wertigkeit', both descending
 
         # Display the aggregated DataFrame
         st.write("**Gesammelte Mittel:**")
@@ -0,0 +1,249 @@
+# bench_hot_paths.py
+#
+# Microbenchmarks of the hot paths of a session on synthetic data:
+#
+# - search: search_top_similar_symptoms over a corpus of 256 dimensional rubrics
+# - remedies: get_remedies of one symptom and get_remedies_bulk of a result page
+# - final_analysis: the remedy table of display_final_analysis for a selection
+#
+# The corpora and the synthesis.db are generated with a fixed seed and
+# get_embeddings is replaced by a deterministic local stub, so no network and no
+# credentials are needed:
+#
+#   python benchmarks/bench_hot_paths.py --sizes 10000,100000,1000000
+#   python benchmarks/bench_hot_paths.py --save-baseline
+#   python benchmarks/bench_hot_paths.py --check
+#
+# --check exits with status 1 if a case got slower than the stored baseline by
+# more than --tolerance.
+
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+# The benchmark gets its own caches, so it never reads or fills those of the app
+WORK_DIR = tempfile.mkdtemp(prefix='z-bench-')
+os.environ.setdefault('Z_CACHE_DIR', os.path.join(WORK_DIR, 'cache'))
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'app'))
+
+import helpers  # noqa: E402
+from helpers import search_top_similar_symptoms, get_remedies, get_remedies_bulk, get_remedy_matrix  # noqa: E402
+from repertorization import RemedyAccumulator  # noqa: E402
+from symptom_index import SymptomIndex, compute_category_ranges, normalize_rows  # noqa: E402
+from synthetic import DIMENSIONS, stub_embeddings, category_sizes, synthetic_paths, synthetic_synthesis_db  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+SEED = 20240601
+
+# Categories of the synthetic corpus, sized roughly like the repertory chapters
+CATEGORIES = [
+    'Gemüt', 'Schwindel', 'Kopf', 'Auge', 'Sehen', 'Ohr', 'Hören', 'Nase', 'Gesicht', 'Mund',
+    'Zähne', 'Innerer Hals', 'Äußerer Hals', 'Magen', 'Abdomen', 'Rektum', 'Stuhl', 'Blase',
+    'Nieren', 'Urin', 'Genitalien männlich', 'Genitalien weiblich', 'Kehlkopf', 'Atmung',
+    'Husten', 'Auswurf', 'Brust', 'Rücken', 'Extremitäten', 'Schlaf', 'Träume', 'Frost',
+    'Fieber', 'Schweiß', 'Haut', 'Allgemeines',
+]
+
+# Number of results of a search and of the result page that is prefetched
+SEARCH_TOP_N = 100
+PAGE_SIZE = 50
+
+
+def synthetic_index(rows, rng):
+    """
+    Builds a SymptomIndex of rows random normalized embeddings, generated block wise
+    so corpora of millions of rows do not need float64 temporaries.
+    """
+    categories = np.repeat(np.asarray(CATEGORIES, dtype=object), category_sizes(rows, CATEGORIES, rng))
+    matrix = np.empty((rows, DIMENSIONS), dtype=np.float32)
+    for start in range(0, rows, 65536):
+        block = matrix[start:start + 65536]
+        block[:] = rng.standard_normal(block.shape, dtype=np.float32)
+        normalize_rows(block)
+    paths = synthetic_paths(rows, rng)
+    return SymptomIndex(np.arange(rows, dtype=np.int64), categories, paths, matrix, compute_category_ranges(categories))
+
+
+def measure(function, arguments, warmup=3):
+    """
+    Calls function once per argument tuple and returns the latencies in milliseconds
+    and the largest peak of traced memory of a single call in KiB.
+
+    Latencies are measured without tracemalloc, the peak memory in a second pass.
+    """
+    for args in arguments[:warmup]:
+        function(*args)
+    gc.collect()
+    latencies = []
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    peak = 0
+    tracemalloc.start()
+    for args in arguments[:min(len(arguments), 20)]:
+        tracemalloc.reset_peak()
+        function(*args)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+    return np.asarray(latencies), peak / 1024
+
+
+def summarize(latencies, peak_kib):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        'calls': len(latencies),
+        'p50_ms': round(float(p50), 3),
+        'p95_ms': round(float(p95), 3),
+        'p99_ms': round(float(p99), 3),
+        'peak_kib': round(float(peak_kib), 1),
+    }
+
+
+def final_analysis(symptom_ids, db_path):
+    """
+    The aggregation of display_final_analysis: include the selected symptoms one by
+    one as the checkboxes do, then read the ranked and renamed table.
+    """
+    remedy_matrix = get_remedy_matrix(db_path)
+    final_results = RemedyAccumulator()
+    for symptom_id in symptom_ids:
+        final_results.include(symptom_id, remedy_matrix)
+    aggregated_df = final_results.table(remedy_matrix)
+    aggregated_df.rename(columns={
+        'abbreviation': 'Kürzel',
+        'description': 'Mittel',
+        'total_occurrence': 'Summe Symptom',
+        'total_degree': 'Summe Wertigkeit'
+    }, inplace=True)
+    return aggregated_df
+
+
+def run(sizes, db_symptoms, repeat, selection_sizes):
+    """
+    Runs all cases and returns a dict mapping each case name to its summary.
+    """
+    rng = np.random.default_rng(SEED)
+    results = {}
+
+    # the remedy cases share one database, its symptoms are the first ids of every corpus
+    db_path = os.path.join(WORK_DIR, 'synthesis.db')
+    start = time.perf_counter()
+    links = synthetic_synthesis_db(db_path, db_symptoms, rng)
+    print(f"synthesis.db: {db_symptoms} symptoms, {links} remedy links ({time.perf_counter() - start:.1f}s)")
+
+    ids = rng.integers(0, db_symptoms, repeat)
+    results['remedies/single'] = summarize(*measure(lambda symptom_id: get_remedies(int(symptom_id), db_path), [(i,) for i in ids]))
+    pages = [(rng.integers(0, db_symptoms, PAGE_SIZE),) for _ in range(repeat)]
+    results[f'remedies/bulk_{PAGE_SIZE}'] = summarize(*measure(lambda page: get_remedies_bulk(page, db_path), pages))
+
+    # the remedy matrix is loaded once per database version, report it separately
+    start = time.perf_counter()
+    get_remedy_matrix(db_path)
+    results['final_analysis/load_matrix'] = {'calls': 1, 'p50_ms': round((time.perf_counter() - start) * 1000, 3)}
+    for count in selection_sizes:
+        selections = [(rng.choice(db_symptoms, count, replace=False),) for _ in range(repeat)]
+        results[f'final_analysis/{count}_symptoms'] = summarize(
+            *measure(lambda selection: final_analysis(selection, db_path), selections)
+        )
+
+    for rows in sizes:
+        start = time.perf_counter()
+        index = synthetic_index(rows, rng)
+        print(f"corpus: {rows} rows, {index.matrix.nbytes / 2**20:.0f} MiB ({time.perf_counter() - start:.1f}s)")
+        # queries are spread over the categories like the LLM classifications
+        categories = rng.choice(list(index.category_ranges), repeat)
+        queries = [
+            (f'benchmark query {number}', index, category, '')
+            for number, category in enumerate(categories)
+        ]
+        results[f'search/{rows}'] = summarize(
+            *measure(lambda query, index, ober, unter: search_top_similar_symptoms(query, index, ober, unter, SEARCH_TOP_N, mode='vector'), queries)
+        )
+        del index, queries
+        gc.collect()
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints each case next to its baseline and returns the names of the cases whose
+    p50 or p95 latency grew by more than tolerance.
+    """
+    regressions = []
+    print(f"{'case':<32}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KiB':>12}{'p50 vs base':>14}")
+    for name, summary in results.items():
+        reference = baseline.get(name)
+        change = ''
+        if reference and reference.get('p50_ms'):
+            ratio = summary['p50_ms'] / reference['p50_ms']
+            change = f'{ratio - 1:+.0%}'
+            if ratio > 1 + tolerance or summary.get('p95_ms', 0) > reference.get('p95_ms', float('inf')) * (1 + tolerance):
+                regressions.append(name)
+                change += ' !'
+        print(
+            f"{name:<32}{summary['p50_ms']:>10}{summary.get('p95_ms', ''):>10}"
+            f"{summary.get('p99_ms', ''):>10}{summary.get('peak_kib', ''):>12}{change:>14}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the search, remedy lookup and final analysis paths.")
+    parser.add_argument('--sizes', default='10000,100000,1000000,4000000',
+                        help="comma separated corpus sizes in rubrics")
+    parser.add_argument('--db-symptoms', type=int, default=200000,
+                        help="number of symptoms in the generated synthesis.db")
+    parser.add_argument('--repeat', type=int, default=200, help="calls per case")
+    parser.add_argument('--selections', default='10,50', help="comma separated numbers of selected symptoms")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--check', action='store_true', help="exit with status 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative slowdown")
+    parser.add_argument('--output', help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    # the search calls the stub instead of the OpenAI API
+    helpers.get_embeddings = stub_embeddings
+
+    results = run(
+        [int(size) for size in args.sizes.split(',')],
+        args.db_symptoms,
+        args.repeat,
+        [int(count) for count in args.selections.split(',')]
+    )
+    # ru_maxrss is in KiB on Linux
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"baseline saved to {args.baseline}")
+    elif regressions:
+        print(f"slower than the baseline: {', '.join(regressions)}")
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+# fake_services.py
+#
+# Local stand-ins for the OpenAI API and S3, so the app can be driven headlessly
+# without credentials or network:
+#
+# - FakeOpenAI serves /v1/chat/completions (streamed and not) with classifications
+#   valid under the kategorie_schema, and /v1/embeddings with the deterministic
+#   embeddings of synthetic.stub_embeddings, both after a configurable latency.
+# - FakeS3 serves HEAD and GET, including ranged GETs, of local files.
+#
+# The app reaches them through OPENAI_BASE_URL and AWS_ENDPOINT_URL_S3.
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from synthetic import stub_embeddings
+
+# Unterkategorien of the kategorie_schema the fake classification chooses from
+UNTERKATEGORIEN = [
+    'Schwindel', 'Kopf', 'Auge', 'Sehen', 'Ohr', 'Hören', 'Nase', 'Gesicht', 'Mund', 'Zähne',
+    'Innerer Hals', 'Äußerer Hals', 'Magen', 'Abdomen', 'Rektum', 'Stuhl', 'Blase', 'Nieren',
+    'Urin', 'Atmung', 'Husten', 'Auswurf', 'Brust', 'Rücken', 'Extremitäten', 'Schlaf',
+    'Träume', 'Frost', 'Fieber', 'Schweiß', 'Haut',
+]
+
+# Categories a search can resolve to, see symptom_index.resolve_category
+CATEGORIES = ['Gemüt', 'Allgemein'] + UNTERKATEGORIEN
+
+
+def fake_classification(text):
+    """
+    Returns a deterministic classification of text as the JSON string gpt-4o would send.
+    """
+    digest = hashlib.sha256(text.encode('utf-8')).digest()
+    oberkategorie = ('Körper', 'Körper', 'Gemüt', 'Allgemein')[digest[0] % 4]
+    unterkategorie = UNTERKATEGORIEN[digest[1] % len(UNTERKATEGORIEN)] if oberkategorie == 'Körper' else 'Nicht anwendbar'
+    category = unterkategorie if oberkategorie == 'Körper' else oberkategorie
+    return json.dumps({
+        'Symptom': text,
+        'Oberkategorie': oberkategorie,
+        'Unterkategorie': unterkategorie,
+        'Suchpfad': f'{category} - {text}',
+        'Begründung': 'Synthetische Klassifikation für den Lasttest.',
+    }, ensure_ascii=False)
+
+
+def last_user_text(messages):
+    content = [message for message in messages if message['role'] == 'user'][-1]['content']
+    if isinstance(content, list):
+        return ''.join(part.get('text', '') for part in content)
+    return content
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path.endswith('/embeddings'):
+            self.embeddings(body)
+        elif self.path.endswith('/chat/completions'):
+            self.chat_completions(body)
+        else:
+            self.send_json({'error': {'message': f'unknown path {self.path}'}}, status=404)
+
+    def send_json(self, payload, status=200):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def embeddings(self, body):
+        self.server.requests['embeddings'] += 1
+        time.sleep(self.server.embedding_latency)
+        texts = body['input'] if isinstance(body['input'], list) else [body['input']]
+        embeddings = stub_embeddings(texts, body.get('model', ''), body.get('dimensions', 256))
+        data = []
+        for number, embedding in enumerate(embeddings):
+            if body.get('encoding_format') == 'base64':
+                # the Python client asks for base64 encoded little endian float32
+                value = base64.b64encode(np.asarray(embedding, dtype='<f4').tobytes()).decode('ascii')
+            else:
+                value = embedding.tolist()
+            data.append({'object': 'embedding', 'index': number, 'embedding': value})
+        tokens = sum(len(text.split()) for text in texts)
+        self.send_json({
+            'object': 'list',
+            'data': data,
+            'model': body.get('model', ''),
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        })
+
+    def chat_completions(self, body):
+        self.server.requests['chat'] += 1
+        content = fake_classification(last_user_text(body['messages']))
+        created = int(time.time())
+        prompt_tokens = sum(len(json.dumps(message, ensure_ascii=False)) // 4 for message in body['messages'])
+        completion_tokens = len(content) // 4
+        time.sleep(self.server.chat_latency)
+
+        if not body.get('stream'):
+            self.send_json({
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion',
+                'created': created,
+                'model': body['model'],
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': content},
+                    'logprobs': None,
+                    'finish_reason': 'stop',
+                }],
+                'usage': {
+                    'prompt_tokens': prompt_tokens,
+                    'completion_tokens': completion_tokens,
+                    'total_tokens': prompt_tokens + completion_tokens,
+                },
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        deltas = [{'role': 'assistant', 'content': ''}]
+        deltas += [{'content': content[start:start + 8]} for start in range(0, len(content), 8)]
+        for number, delta in enumerate(deltas + [{}]):
+            chunk = {
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': body['model'],
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': None if delta else 'stop'}],
+            }
+            self.write_chunk(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n')
+            if 0 < number < len(deltas):
+                # one chunk of 8 characters is about 2 tokens
+                time.sleep(2 * self.server.token_latency)
+        self.write_chunk('data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def serve(self, send_body):
+        # path style addressing: /bucket/key
+        local_path = self.server.objects.get(self.path.split('?')[0].lstrip('/'))
+        if local_path is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.server.requests['GET' if send_body else 'HEAD'] += 1
+        size = os.path.getsize(local_path)
+        start, stop, status = 0, size, 200
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[len('bytes='):].partition('-')
+            start = int(first)
+            stop = min(int(last) + 1, size) if last else size
+            status = 206
+
+        self.send_response(status)
+        self.send_header('ETag', f'"{self.server.etags[local_path]}"')
+        self.send_header('Last-Modified', formatdate(os.path.getmtime(local_path), usegmt=True))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(stop - start))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{stop - 1}/{size}')
+        self.end_headers()
+        if send_body:
+            with open(local_path, 'rb') as f:
+                f.seek(start)
+                self.wfile.write(f.read(stop - start))
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.requests = Counter()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+
+class FakeOpenAI(FakeServer):
+    """
+    Local OpenAI API with configurable latencies in seconds: chat_latency before the
+    first token, token_latency per streamed token and embedding_latency per request.
+    """
+
+    def __init__(self, chat_latency=1.0, token_latency=0.02, embedding_latency=0.2):
+        super().__init__(FakeOpenAIHandler)
+        self.chat_latency = chat_latency
+        self.token_latency = token_latency
+        self.embedding_latency = embedding_latency
+
+
+class FakeS3(FakeServer):
+    """
+    Local S3 serving files as objects, see add_object.
+    """
+
+    def __init__(self):
+        super().__init__(FakeS3Handler)
+        self.objects = {}
+        self.etags = {}
+
+    def add_object(self, bucket_name, s3_key, local_path):
+        """
+        Serves local_path as s3://bucket_name/s3_key with the MD5 of its content as ETag.
+        """
+        digest = hashlib.md5()
+        with open(local_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        self.objects[f'{bucket_name}/{s3_key}'] = local_path
+        self.etags[local_path] = digest.hexdigest()
@@ -0,0 +1,227 @@
+# load_test.py
+#
+# Headless load test of the step machine of app_pre.py. Simulated practitioners
+# are driven through input_symptom_class -> processing_symptom_class ->
+# display_symptom_class_results -> search -> mittelsuche -> final_analysis with
+# Streamlit's AppTest, against a local fake OpenAI API and a local fake S3 serving
+# a synthetic symptom parquet and synthesis.db:
+#
+#   python benchmarks/load_test.py --sessions 40 --concurrency 8 --processes 2
+#
+# Every worker process is one replica: its sessions share the process-wide symptom
+# index, connection pools and caches, and all processes share one working
+# directory like the workers of one node. The report lists the throughput, the
+# p50/p95/p99 latency of every step and the peak RSS of every process.
+#
+# The AgGrid selection is a custom component AppTest can not click, so the
+# harness selects the best rows of the search and applies the effect of the
+# "Mittel finden" callback directly.
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from fake_services import FakeOpenAI, FakeS3, CATEGORIES
+from synthetic import write_symptom_parquet, synthetic_synthesis_db
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'app')
+
+BUCKET_NAME = 'project-z-mambo'
+SYMPTOMS_KEY = 'symptoms/relevant_symptoms.gz'
+SYNTHESIS_KEY = 'symptoms/synthesis.db'
+
+# Secrets read by app_pre.py, the fake services accept any credentials
+SECRETS = {
+    'AWS_ACCESS_KEY_ID': 'load-test',
+    'AWS_SECRET_ACCESS_KEY': 'load-test',
+    'AWS_DEFAULT_REGION': 'eu-central-1',
+    'OPENAI_KEY': 'load-test',
+}
+
+SYMPTOMS = [
+    'Stechende Kopfschmerzen morgens, besser durch Druck',
+    'Angst vor dem Alleinsein abends',
+    'Brennende Schmerzen im Magen nach dem Essen',
+    'Trockener Husten nachts im Liegen',
+    'Juckender Hautausschlag schlimmer durch Wärme',
+    'Schwindel beim Aufstehen aus dem Liegen',
+]
+
+
+def button(at, label):
+    return next(widget for widget in at.button if widget.label == label)
+
+
+def run_session(number, timeout, selections):
+    """
+    Drives one session through all steps.
+
+    Returns:
+    - List of (step, seconds) and the error that ended the session early, or None.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    # relative paths are resolved against this file, the app runs from the working directory
+    at = AppTest.from_file(os.path.join(os.getcwd(), 'app', 'app_pre.py'), default_timeout=timeout)
+    for key, value in SECRETS.items():
+        at.secrets[key] = value
+    timings = []
+
+    def step(name, action, expected_step):
+        start = time.perf_counter()
+        action()
+        timings.append((name, time.perf_counter() - start))
+        if at.exception:
+            raise RuntimeError(f'{name}: {at.exception[0].value}')
+        if at.session_state['current_step'] != expected_step:
+            raise RuntimeError(f'{name}: ended in {at.session_state["current_step"]} instead of {expected_step}')
+
+    try:
+        step('load', at.run, 'input_symptom_class')
+
+        # a distinct input per session, so the classification cache does not hide the API
+        at.text_area[0].input(f'{SYMPTOMS[number % len(SYMPTOMS)]} (Fall {number})')
+        step('processing_symptom_class', button(at, 'Symptom analysieren').click().run, 'display_symptom_class_results')
+        step('search', button(at, 'Analyse ist OK - Suchpfad finden.').click().run, 'search')
+
+        # select the best rows and apply the effect of proceed_to_mittelsuche
+        top_results = at.session_state['top_results']
+        if top_results.empty:
+            raise RuntimeError('search: no results')
+        selected = top_results.nlargest(selections, 'similarity')[['id', 'category', 'path', 'similarity']]
+        at.session_state['selected_rows'] = selected.reset_index(drop=True)
+        at.session_state['current_step'] = 'mittelsuche'
+        for key in ('top_results', 'search_performed', 'keywords', 'filtered_results_grid'):
+            if key in at.session_state:
+                del at.session_state[key]
+        step('mittelsuche', at.run, 'mittelsuche')
+
+        # include the remedies of every selected symptom that has any
+        for symptom_id in selected['id']:
+            try:
+                at.checkbox(key=f'include_remedies_{symptom_id}').check()
+            except KeyError:
+                continue
+        step('include_remedies', at.run, 'mittelsuche')
+        step('final_analysis', button(at, 'Weiter zu Finalem Analyse Ergebnis').click().run, 'final_analysis')
+    except Exception as e:
+        return timings, f'{type(e).__name__}: {e}'
+    return timings, None
+
+
+def current_rss_mib():
+    # resident pages of this process, Linux only
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return float('nan')
+
+
+def run_worker(worker, session_numbers, work_dir, concurrency, timeout, selections):
+    """
+    Runs the sessions of one worker process with concurrency sessions at a time.
+    """
+    os.chdir(work_dir)
+    sys.path.insert(0, os.path.join(work_dir, 'app'))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda number: run_session(number, timeout, selections), session_numbers))
+    return {
+        'worker': worker,
+        'results': results,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'rss_mib': current_rss_mib(),
+    }
+
+
+def prepare(work_dir, rubrics, db_symptoms, seed):
+    """
+    Writes the synthetic objects and the working directory the workers run in.
+
+    Returns:
+    - Dict mapping each S3 key to its local file.
+    """
+    rng = np.random.default_rng(seed)
+    objects_dir = os.path.join(work_dir, 's3')
+    os.makedirs(objects_dir)
+    symptoms_path = os.path.join(objects_dir, 'relevant_symptoms.gz')
+    synthesis_path = os.path.join(objects_dir, 'synthesis.db')
+    write_symptom_parquet(symptoms_path, rubrics, CATEGORIES, rng)
+    links = synthetic_synthesis_db(synthesis_path, min(db_symptoms, rubrics), rng)
+    print(f"data: {rubrics} rubrics, {links} remedy links in {work_dir}")
+    # the app reads ./app/images and writes synthesis.db and .cache to the working directory
+    os.symlink(os.path.abspath(APP_DIR), os.path.join(work_dir, 'app'))
+    return {SYMPTOMS_KEY: symptoms_path, SYNTHESIS_KEY: synthesis_path}
+
+
+def report(workers, seconds):
+    timings = {}
+    completed, errors = 0, []
+    for worker in workers:
+        for session_timings, error in worker['results']:
+            for name, duration in session_timings:
+                timings.setdefault(name, []).append(duration * 1000)
+            if error is None:
+                completed += 1
+            else:
+                errors.append(error)
+
+    print(f"\n{completed} sessions completed, {len(errors)} failed in {seconds:.1f}s "
+          f"({completed / seconds:.2f} sessions/s)")
+    print(f"{'step':<28}{'runs':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, values in timings.items():
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        print(f"{name:<28}{len(values):>6}{p50:>10.0f}{p95:>10.0f}{p99:>10.0f}{max(values):>10.0f}")
+    for worker in workers:
+        print(f"process {worker['worker']}: peak RSS {worker['peak_rss_mib']:.0f} MiB, "
+              f"RSS at end {worker['rss_mib']:.0f} MiB")
+    for error in sorted(set(errors))[:10]:
+        print(f"error: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive simulated sessions through the app headlessly.")
+    parser.add_argument('--sessions', type=int, default=20, help="total number of sessions")
+    parser.add_argument('--concurrency', type=int, default=4, help="concurrent sessions per process")
+    parser.add_argument('--processes', type=int, default=1, help="worker processes, one per simulated replica")
+    parser.add_argument('--rubrics', type=int, default=50000, help="rubrics of the synthetic corpus")
+    parser.add_argument('--db-symptoms', type=int, default=50000, help="symptoms of the synthetic synthesis.db")
+    parser.add_argument('--selections', type=int, default=3, help="symptoms selected per session")
+    parser.add_argument('--chat-latency', type=float, default=1.0, help="seconds before the first token")
+    parser.add_argument('--token-latency', type=float, default=0.02, help="seconds per streamed token")
+    parser.add_argument('--embedding-latency', type=float, default=0.2, help="seconds per embeddings request")
+    parser.add_argument('--timeout', type=float, default=120, help="seconds per script run")
+    parser.add_argument('--seed', type=int, default=20240601)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='z-load-')
+    objects = prepare(work_dir, args.rubrics, args.db_symptoms, args.seed)
+
+    openai_server = FakeOpenAI(args.chat_latency, args.token_latency, args.embedding_latency).start()
+    s3_server = FakeS3().start()
+    for s3_key, local_path in objects.items():
+        s3_server.add_object(BUCKET_NAME, s3_key, local_path)
+    # inherited by the spawned workers
+    os.environ['OPENAI_BASE_URL'] = f'{openai_server.url}/v1'
+    os.environ['AWS_ENDPOINT_URL_S3'] = s3_server.url
+
+    numbers = list(range(args.sessions))
+    shares = [numbers[worker::args.processes] for worker in range(args.processes)]
+    start = time.perf_counter()
+    with multiprocessing.get_context('spawn').Pool(args.processes) as pool:
+        workers = pool.starmap(run_worker, [
+            (worker, share, work_dir, args.concurrency, args.timeout, args.selections)
+            for worker, share in enumerate(shares)
+        ])
+    report(workers, time.perf_counter() - start)
+    print(f"requests: OpenAI {dict(openai_server.requests)}, S3 {dict(s3_server.requests)}")
+
+
+if __name__ == "__main__":
+    main()
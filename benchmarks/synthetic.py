@@ -0,0 +1,112 @@
+# synthetic.py
+#
+# Seeded synthetic stand-ins for the data of the app: query embeddings, the
+# symptom parquet and synthesis.db. Shared by the benchmarks and the load test.
+
+import hashlib
+import sqlite3
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DIMENSIONS = 256
+
+# Number of remedies in the synthetic synthesis.db
+REMEDIES = 2500
+
+WORDS = [
+    'Schmerz', 'brennend', 'stechend', 'drückend', 'morgens', 'abends', 'nachts', 'links',
+    'rechts', 'Bewegung', 'Ruhe', 'Wärme', 'Kälte', 'Essen', 'nach', 'vor', 'während',
+    'amel.', 'agg.', 'Angst', 'Schwäche', 'Schwellung', 'Jucken', 'Taubheit', 'Kribbeln',
+]
+
+
+def stub_embeddings(texts, model="text-embedding-3-large", dimensions=DIMENSIONS):
+    """
+    Deterministic local stand-in for get_embeddings: a normalized random vector
+    seeded by the hash of each text.
+    """
+    embeddings = []
+    for text in texts:
+        seed = int.from_bytes(hashlib.sha256(f'{model}:{dimensions}:{text}'.encode('utf-8')).digest()[:8], 'little')
+        embedding = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+        embeddings.append(embedding / np.linalg.norm(embedding))
+    return embeddings
+
+
+def category_sizes(rows, categories, rng):
+    """
+    Splits rows into skewed category sizes, a few chapters hold most rubrics.
+    """
+    weights = rng.pareto(1.2, len(categories)) + 0.05
+    sizes = np.floor(weights / weights.sum() * rows).astype(np.int64)
+    sizes[np.argmax(sizes)] += rows - sizes.sum()
+    return sizes
+
+
+def synthetic_paths(rows, rng):
+    """
+    Returns rows symptom paths; the rows share a small pool of path strings.
+    """
+    words = np.asarray(WORDS, dtype=object)
+    phrases = np.asarray([' '.join(words[rng.integers(0, len(words), 4)]) for _ in range(1000)], dtype=object)
+    return phrases[rng.integers(0, len(phrases), rows)]
+
+
+def write_symptom_parquet(path, rows, categories, rng):
+    """
+    Writes a symptom parquet with the columns the app reads: 'id', 'category',
+    'path' and 'path_embeddings' as a list<float> column.
+    """
+    category_column = np.repeat(np.asarray(categories, dtype=object), category_sizes(rows, categories, rng))
+    embeddings = rng.standard_normal((rows, DIMENSIONS), dtype=np.float32)
+    table = pa.table({
+        'id': np.arange(rows, dtype=np.int64),
+        'category': category_column.tolist(),
+        'path': synthetic_paths(rows, rng).tolist(),
+        'path_embeddings': pa.ListArray.from_arrays(
+            np.arange(0, rows * DIMENSIONS + 1, DIMENSIONS, dtype=np.int32),
+            embeddings.ravel()
+        ),
+    })
+    pq.write_table(table, path, compression='gzip')
+
+
+def synthetic_synthesis_db(db_path, symptoms, rng):
+    """
+    Writes a synthesis.db with the schema the app reads. The number of remedies per
+    symptom is heavy-tailed: most rubrics list a handful, a few list hundreds. Remedy
+    popularity is Zipf distributed and degrees 1 to 4 get rarer with height.
+
+    Returns:
+    - Number of symptom remedy links written.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE remedies (remedy_abbreviation TEXT PRIMARY KEY, description TEXT)")
+    conn.execute("CREATE TABLE symptom_remedies (symptom_id INTEGER, remedy_abbreviation TEXT, degree INTEGER)")
+    abbreviations = [f'rem{number:04d}.' for number in range(REMEDIES)]
+    conn.executemany(
+        "INSERT INTO remedies VALUES (?, ?)",
+        ((abbreviation, f'Remedium {number}') for number, abbreviation in enumerate(abbreviations))
+    )
+
+    popularity = 1.0 / np.arange(1, REMEDIES + 1)
+    popularity /= popularity.sum()
+    links = 0
+    for start in range(0, symptoms, 10000):
+        stop = min(start + 10000, symptoms)
+        fan_out = np.minimum(rng.lognormal(2.0, 1.0, stop - start).astype(np.int64) + 1, 600)
+        symptom_ids = np.repeat(np.arange(start, stop, dtype=np.int64), fan_out)
+        remedies = rng.choice(REMEDIES, size=len(symptom_ids), p=popularity)
+        # a remedy is listed at most once per symptom
+        pairs = np.unique(symptom_ids * REMEDIES + remedies)
+        symptom_ids, remedies = pairs // REMEDIES, pairs % REMEDIES
+        degrees = rng.choice(4, size=len(pairs), p=[0.55, 0.25, 0.15, 0.05]) + 1
+        conn.executemany(
+            "INSERT INTO symptom_remedies VALUES (?, ?, ?)",
+            zip(symptom_ids.tolist(), (abbreviations[remedy] for remedy in remedies), degrees.tolist())
+        )
+        links += len(pairs)
+    conn.commit()
+    conn.close()
+    return links